@@ -31,13 +31,28 @@ from flask_login import (
     logout_user,
 )
 from flask_sqlalchemy import SQLAlchemy
-from github import Github
 from github.GithubException import UnknownObjectException
+from sqlalchemy import or_
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm.exc import NoResultFound
 from werkzeug.middleware.proxy_fix import ProxyFix
 
-from jobs import pull, upsert
-from utils import Base, get_cached, save_cache
+from jobs import get_queue_stats, pull, upsert
+from utils import (
+    Base,
+    CacheEntry,
+    RestGitHub,
+    decode_cache_value,
+    decode_readme,
+    enqueue_once,
+    get_cache_stats,
+    get_cached,
+    get_cached_entry,
+    save_cache,
+    split_cache_value,
+    single_flight,
+    upgrade_schema,
+)
 
 # create flask app
 app = Flask(__name__, static_folder="./frontend/dist", static_url_path="/")
@@ -57,6 +72,11 @@ db = SQLAlchemy(app)
 class OAuth(OAuthConsumerMixin, UserMixin, db.Model):
     login = db.Column(db.String(256), unique=True, nullable=False)
     pulled_at = db.Column(db.DateTime())
+    starred_count = db.Column(db.Integer())
+    starred_at = db.Column(db.DateTime())
+    lease_owner = db.Column(db.String(32))
+    lease_until = db.Column(db.DateTime())
+    seen_at = db.Column(db.DateTime(), index=True)
 
 
 
@@ -74,7 +94,7 @@ cors = CORS(app, resources={r"/api/*": {"origins": "*"}}, supports_credentials=T
 
 # create gorse client and github client
 gorse_client = gorse.Gorse(os.getenv("GORSE_ADDRESS"), os.getenv("GORSE_API_KEY"))
-global_github_client = Github(os.getenv("GITHUB_ACCESS_TOKEN"))
+global_github_client = RestGitHub(os.getenv("GITHUB_ACCESS_TOKEN"))
 
 login_manager = LoginManager()
 login_manager.init_app(app)
@@ -113,7 +133,7 @@ def github_logged_in(blueprint, token):
         )
         db.session.add_all([oauth])
         db.session.commit()
-        pull.delay(token["access_token"])
+        enqueue_once(pull, f"pull:{github_login.lower()}", token["access_token"])
 
     login_user(oauth)
     flash("Successfully signed in with GitHub.")
@@ -142,56 +162,84 @@ def privacy():
     return app.send_static_file("index.html")
 
 
-@app.route("/api/trending")
-def get_trending():
-    """Fetch trending repositories from GitHub Trending API."""
-    language = request.args.get("language", "all")
-    since = request.args.get("since", "daily")
+def cached_response(entry: CacheEntry, cache_control: Optional[str] = None) -> Response:
+    """
+    Serve a cache entry as JSON. The ETag and the gzipped body were computed
+    when the entry was saved, so this neither serializes nor compresses.
+    """
+    if request.if_none_match.contains(entry.etag):
+        response = Response(status=304)
+    else:
+        codec, payload = split_cache_value(entry.blob)
+        if codec == "gzip" and request.accept_encodings["gzip"]:
+            response = Response(payload, mimetype="application/json")
+            response.headers["Content-Encoding"] = "gzip"
+        else:
+            response = Response(
+                decode_cache_value(entry.blob), mimetype="application/json"
+            )
+    response.set_etag(entry.etag)
+    response.vary.add("Accept-Encoding")
+    if cache_control is not None:
+        response.headers["Cache-Control"] = cache_control
+    return response
 
-    # Check cache first (cache key: trending:{language}:{since})
-    cache_key = f"api:trending:{language}:{since}"
-    cached = get_cached(cache_key)
-    if cached is not None:
-        response = make_response(cached)
-        response.headers["Cache-Control"] = "public, max-age=3600, s-maxage=3600"
-        return response
 
-    # Fetch from GitHub Trending API
+def load_trending(language: str, since: str) -> list:
+    """Fetch trending repositories from GitHub Trending API and save them to cache."""
     url = (
         "https://raw.githubusercontent.com/isboyjc/github-trending-api/main/"
         f"data/{since}/{language}.json"
     )
-
-    try:
-        resp = requests.get(url, timeout=10)
-        resp.raise_for_status()
-        payload = resp.json()
-    except requests.RequestException as e:
-        app.logger.error(f"Error fetching trending: {e}")
-        return {"error": "Failed to fetch trending repositories"}, 500
-    except ValueError as e:
-        app.logger.error(f"Error decoding trending response: {e}")
-        return {"error": "Failed to decode trending repositories"}, 502
+    resp = requests.get(url, timeout=10)
+    resp.raise_for_status()
+    payload = resp.json()
 
     if not isinstance(payload, dict):
-        app.logger.error(
+        raise TypeError(
             f"Unexpected trending response type: {type(payload).__name__}"
         )
-        return {"error": "Unexpected trending repositories response"}, 502
 
     repos = payload.get("items")
     if not isinstance(repos, list):
-        app.logger.error(
+        raise TypeError(
             f"Unexpected trending items type: {type(repos).__name__}"
         )
-        return {"error": "Unexpected trending repositories response"}, 502
 
-    # Save to cache (1 hour expiry for trending data)
-    save_cache(cache_key, repos, expiry_hours=1)
+    # Save to cache (1 hour expiry for trending data, served stale for another hour)
+    save_cache(f"api:trending:{language}:{since}", repos, expiry_hours=1, stale_hours=1)
+    return repos
 
-    response = make_response(repos)
-    response.headers["Cache-Control"] = "public, max-age=3600, s-maxage=3600"
-    return response
+
+@app.route("/api/trending")
+def get_trending():
+    """Fetch trending repositories from GitHub Trending API."""
+    language = request.args.get("language", "all")
+    since = request.args.get("since", "daily")
+
+    # Check cache first (cache key: trending:{language}:{since})
+    cache_key = f"api:trending:{language}:{since}"
+    entry = get_cached_entry(cache_key, refresh=lambda: load_trending(language, since))
+    if entry is None:
+        # Only one request fetches from upstream, the others wait for it.
+        try:
+            repos = single_flight(cache_key, lambda: load_trending(language, since))
+        except requests.RequestException as e:
+            app.logger.error(f"Error fetching trending: {e}")
+            return {"error": "Failed to fetch trending repositories"}, 500
+        except ValueError as e:
+            app.logger.error(f"Error decoding trending response: {e}")
+            return {"error": "Failed to decode trending repositories"}, 502
+        except TypeError as e:
+            app.logger.error(str(e))
+            return {"error": "Unexpected trending repositories response"}, 502
+        entry = get_cached_entry(cache_key)
+        if entry is None:
+            response = make_response(repos)
+            response.headers["Cache-Control"] = "public, max-age=3600, s-maxage=3600"
+            return response
+
+    return cached_response(entry, "public, max-age=3600, s-maxage=3600")
 
 
 def fetch_hackernews_repo(story_id: int) -> Optional[dict]:
@@ -233,39 +281,71 @@ def fetch_hackernews_repo(story_id: int) -> Optional[dict]:
         return None
 
 
+def load_hackernews() -> list:
+    """Fetch GitHub repositories from Hacker News and save them to cache."""
+    # Get top stories from Hacker News
+    topstories_url = "https://hacker-news.firebaseio.com/v0/showstories.json"
+    resp = requests.get(topstories_url, timeout=10)
+    resp.raise_for_status()
+    story_ids = resp.json()
+
+    # Fetch details for top 50 stories in parallel while preserving order.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
+        repos = list(executor.map(fetch_hackernews_repo, story_ids[:50]))
+
+    result = [repo for repo in repos if repo is not None]
+
+    # Save to cache (1 hour expiry, served stale for another hour)
+    save_cache("api:hackernews:showstories", result, expiry_hours=1, stale_hours=1)
+    return result
+
+
 @app.route("/api/hackernews")
 def get_hackernews():
     """Fetch GitHub repositories from Hacker News"""
     # Check cache first
     cache_key = "api:hackernews:showstories"
-    cached = get_cached(cache_key)
-    if cached is not None:
-        response = make_response(cached)
-        response.headers["Cache-Control"] = "public, max-age=3600, s-maxage=3600"
-        return response
+    entry = get_cached_entry(cache_key, refresh=load_hackernews)
+    if entry is None:
+        try:
+            result = single_flight(cache_key, load_hackernews)
+        except Exception as e:
+            app.logger.error(f"Error fetching Hacker News: {e}")
+            return {"error": "Failed to fetch Hacker News stories"}, 500
+        entry = get_cached_entry(cache_key)
+        if entry is None:
+            response = make_response(result)
+            response.headers["Cache-Control"] = "public, max-age=3600, s-maxage=3600"
+            return response
 
-    try:
-        # Get top stories from Hacker News
-        topstories_url = "https://hacker-news.firebaseio.com/v0/showstories.json"
-        resp = requests.get(topstories_url, timeout=10)
-        resp.raise_for_status()
-        story_ids = resp.json()
+    return cached_response(entry, "public, max-age=3600, s-maxage=3600")
 
-        # Fetch details for top 50 stories in parallel while preserving order.
-        with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-            repos = list(executor.map(fetch_hackernews_repo, story_ids[:50]))
 
-        result = [repo for repo in repos if repo is not None]
+@app.route("/api/stats/cache")
+def get_cache_stats_api():
+    """Hit/miss/eviction counters of the KV cache in this worker."""
+    return Response(json.dumps(get_cache_stats()), mimetype="application/json")
 
-        # Save to cache (1 hour expiry)
-        save_cache(cache_key, result, expiry_hours=1)
 
-        response = make_response(result)
-        response.headers["Cache-Control"] = "public, max-age=3600, s-maxage=3600"
-        return response
-    except Exception as e:
-        app.logger.error(f"Error fetching Hacker News: {e}")
-        return {"error": "Failed to fetch Hacker News stories"}, 500
+# Seconds queue stats are cached, to bound broker connections.
+QUEUE_STATS_CACHE_SECONDS = 10
+
+
+def load_queue_stats() -> dict:
+    """Get queue stats from the broker and save them to cache."""
+    stats = get_queue_stats()
+    save_cache("api:stats:queues", stats, expiry_hours=QUEUE_STATS_CACHE_SECONDS / 3600)
+    return stats
+
+
+@app.route("/api/stats/queues")
+@login_required
+def get_queue_stats_api():
+    """Depth and wait time of each task queue."""
+    stats = get_cached("api:stats:queues")
+    if stats is None:
+        stats = single_flight("api:stats:queues", load_queue_stats)
+    return Response(json.dumps(stats), mimetype="application/json")
 
 
 @app.errorhandler(404)
@@ -273,11 +353,39 @@ def page_not_found(e):
     return app.send_static_file("index.html")
 
 
+# Minimum interval between updates of OAuth.seen_at of a user.
+SEEN_AT_INTERVAL = timedelta(minutes=10)
+
+
+def touch_user():
+    """
+    Record that the authenticated user is active. Star sync is scheduled by
+    activity, see cronjobs.claim_users. Writes are throttled to one per
+    SEEN_AT_INTERVAL.
+    """
+    if not current_user.is_authenticated:
+        return
+    login = current_user.login
+    now = datetime.utcnow()
+    if current_user.seen_at is not None and now - current_user.seen_at < SEEN_AT_INTERVAL:
+        return
+    try:
+        OAuth.query.filter(
+            OAuth.login == login,
+            or_(OAuth.seen_at == None, OAuth.seen_at < now - SEEN_AT_INTERVAL),
+        ).update({OAuth.seen_at: now}, synchronize_session=False)
+        db.session.commit()
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        app.logger.error(f"Error updating seen_at of {login}: {e}")
+
+
 # API endpoint for frontend to check authentication status
 @app.route("/api/me")
 def get_me():
     if current_user.is_authenticated:
         session.permanent = True  # Refresh session on auth check
+        touch_user()
         return Response(
             json.dumps({"is_authenticated": True, "login": current_user.login}),
             mimetype="application/json"
@@ -335,6 +443,69 @@ def get_github_repo_full_name(repo_data: dict) -> str:
     return ""
 
 
+def load_repo(github_client: RestGitHub, repo_id: str, full_name: str) -> dict:
+    """Fetch a repository from GitHub, render its README and save it to cache."""
+    repo = github_client.get_repo(full_name)
+    readme = github_client.get_readme(full_name)
+    download_url = readme["download_url"].lower()
+
+    # Convert readme to html
+    content = decode_readme(readme)
+    if download_url.endswith(".rst"):
+        html = publish_parts(content, writer_name="html")["html_body"]
+    elif download_url.endswith((".asciidoc", ".adoc")):
+        infile = io.StringIO(content)
+        outfile = io.StringIO()
+        asciidoc3api = AsciiDoc3API(asciidoc3.__path__[0] + '/asciidoc3.py')
+        asciidoc3api.options('--no-header-footer')
+        asciidoc3api.execute(infile, outfile, backend='html4')
+        html = outfile.getvalue()
+    else:
+        html = mistune.html(content)
+    soup = BeautifulSoup(html, "html.parser")
+    for a in soup.find_all("a"):
+        if "href" in a.attrs:
+            # open links in new tab
+            a.attrs["target"] = "__blank"
+            # redirect links to github
+            src = a.attrs["href"]
+            if not src.startswith("http://") and not src.startswith("https://"):
+                a.attrs["href"] = (
+                    repo["html_url"] + "/blob/" + repo["default_branch"] + "/" + src
+                )
+    for img in soup.find_all("img"):
+        # redirect links to github
+        if "src" in img.attrs:
+            src = img.attrs["src"]
+            if not src.startswith("http://") and not src.startswith("https://"):
+                if src.startswith("./"):
+                    src = src[2:]
+                img.attrs["src"] = (
+                    repo["html_url"] + "/raw/" + repo["default_branch"] + "/" + src
+                )
+            elif is_github_blob(src):
+                img.attrs["src"] = convert_github_blob(src)
+    
+    result = {
+        "item_id": repo_id,
+        "full_name": repo["full_name"],
+        "html_url": repo["html_url"],
+        "stargazers_url": repo["stargazers_url"],
+        "forks_url": repo["forks_url"],
+        "stargazers_count": repo["stargazers_count"],
+        "forks_count": repo["forks_count"],
+        "subscribers_count": repo["subscribers_count"],
+        "language": repo["language"],
+        "readme": emoji.emojize(str(soup), use_aliases=True),
+    }
+
+    # Save to cache (only for public repos to avoid leaking private content)
+    if not repo["private"]:
+        save_cache(f"repo:{repo_id}", result, stale_hours=24)
+
+    return result
+
+
 @app.route("/api/repo")
 @app.route("/api/repo/<category>")
 def get_repo(category: str = ""):
@@ -355,34 +526,23 @@ def get_repo(category: str = ""):
         if repo_id is None:
             return Response("No repository found", status=404)
         
-        # Check cache first
-        cache_key = f"repo:{repo_id}"
-        cached = get_cached(cache_key)
-        if cached is not None:
-            return cached
-        
         full_name = repo_id.replace(":", "/")
-        github_client = Github(current_user.token["access_token"])
+        github_client = RestGitHub(current_user.token["access_token"])
     else:
         # For anonymous users, get a random trending repo
         language = category.lower() if category else "all"
         # First try to get from trending cache
         trending_cache_key = f"api:trending:{language}:daily"
-        trending_data = get_cached(trending_cache_key)
+        trending_data = get_cached(
+            trending_cache_key, refresh=lambda: load_trending(language, "daily")
+        )
         
         if trending_data is None:
             # Fetch trending data if not cached
-            url = (
-                "https://raw.githubusercontent.com/isboyjc/github-trending-api/main/"
-                f"data/daily/{language}.json"
-            )
             try:
-                resp = requests.get(url, timeout=10)
-                resp.raise_for_status()
-                payload = resp.json()
-                trending_data = payload.get("items", [])
-                if trending_data:
-                    save_cache(trending_cache_key, trending_data, expiry_hours=1)
+                trending_data = single_flight(
+                    trending_cache_key, lambda: load_trending(language, "daily")
+                )
             except Exception as e:
                 app.logger.error(f"Error fetching trending for anonymous user: {e}")
                 return Response("Failed to fetch trending repositories", status=500)
@@ -420,75 +580,30 @@ def get_repo(category: str = ""):
         
         repo_id = full_name.replace("/", ":").lower()
         
-        # Check cache first
-        cache_key = f"repo:{repo_id}"
-        cached = get_cached(cache_key)
-        if cached is not None:
-            return cached
-        
         # Use global github client for anonymous users
         github_client = global_github_client
-    
-    # Fetch from GitHub API
-    repo = github_client.get_repo(full_name)
-    readme = repo.get_readme()
-    download_url = readme.download_url.lower()
 
-    # Convert readme to html
-    content = readme.decoded_content.decode("utf-8")
-    if download_url.endswith(".rst"):
-        html = publish_parts(content, writer_name="html")["html_body"]
-    elif download_url.endswith((".asciidoc", ".adoc")):
-        infile = io.StringIO(content)
-        outfile = io.StringIO()
-        asciidoc3api = AsciiDoc3API(asciidoc3.__path__[0] + '/asciidoc3.py')
-        asciidoc3api.options('--no-header-footer')
-        asciidoc3api.execute(infile, outfile, backend='html4')
-        html = outfile.getvalue()
+    # Check cache first
+    cache_key = f"repo:{repo_id}"
+    entry = get_cached_entry(
+        cache_key, refresh=lambda: load_repo(github_client, repo_id, full_name)
+    )
+    if entry is not None:
+        return cached_response(entry)
+
+    # Fetch from GitHub API. Only fetches with the shared client are coalesced,
+    # since a user's token may see private repos that others must not receive.
+    if github_client is global_github_client:
+        result = single_flight(
+            cache_key, lambda: load_repo(github_client, repo_id, full_name)
+        )
     else:
-        html = mistune.html(content)
-    soup = BeautifulSoup(html, "html.parser")
-    for a in soup.find_all("a"):
-        if "href" in a.attrs:
-            # open links in new tab
-            a.attrs["target"] = "__blank"
-            # redirect links to github
-            src = a.attrs["href"]
-            if not src.startswith("http://") and not src.startswith("https://"):
-                a.attrs["href"] = (
-                    repo.html_url + "/blob/" + repo.default_branch + "/" + src
-                )
-    for img in soup.find_all("img"):
-        # redirect links to github
-        if "src" in img.attrs:
-            src = img.attrs["src"]
-            if not src.startswith("http://") and not src.startswith("https://"):
-                if src.startswith("./"):
-                    src = src[2:]
-                img.attrs["src"] = (
-                    repo.html_url + "/raw/" + repo.default_branch + "/" + src
-                )
-            elif is_github_blob(src):
-                img.attrs["src"] = convert_github_blob(src)
-    
-    result = {
-        "item_id": repo_id,
-        "full_name": repo.full_name,
-        "html_url": repo.html_url,
-        "stargazers_url": repo.stargazers_url,
-        "forks_url": repo.forks_url,
-        "stargazers_count": repo.stargazers_count,
-        "forks_count": repo.forks_count,
-        "subscribers_count": repo.subscribers_count,
-        "language": repo.language,
-        "readme": emoji.emojize(str(soup), use_aliases=True),
-    }
-
-    # Save to cache (only for public repos to avoid leaking private content)
-    if not repo.private:
-        save_cache(cache_key, result)
-
-    return result
+        result = load_repo(github_client, repo_id, full_name)
+    # Private repos are not cached and are served directly.
+    entry = get_cached_entry(cache_key)
+    if entry is None:
+        return result
+    return cached_response(entry)
 
 
 @app.route("/api/favorites")
@@ -535,6 +650,7 @@ def read_repo(repo_name: str):
     repo_name = repo_name.lower()
     
     if current_user.is_authenticated:
+        touch_user()
         try:
             return gorse_client.insert_feedback(
                 "read", current_user.login, repo_name, datetime.now().isoformat(), 1
@@ -560,7 +676,7 @@ def delete_repo(repo_name: str):
         full_name = repo_name.replace(":", "/")
         try:
             repo = global_github_client.get_repo(full_name)
-            if repo.full_name.lower() != full_name.lower():
+            if repo["full_name"].lower() != full_name.lower():
                 # This repository has been renamed.
                 return gorse_client.delete_item(repo_name)
         except UnknownObjectException:
@@ -571,21 +687,21 @@ def delete_repo(repo_name: str):
         return Response(e.message, status=e.status_code)
 
 
-def fetch_repo(github_client: Github, item_id: str) -> Optional[dict]:
+def fetch_repo(github_client: RestGitHub, item_id: str) -> Optional[dict]:
     full_name = item_id.replace(":", "/")
     try:
         repo = github_client.get_repo(full_name)
-        if repo.full_name.lower() != full_name.lower():
+        if repo["full_name"].lower() != full_name.lower():
             # This repository has been renamed.
             gorse_client.delete_item(item_id)
             return None
         return {
             "item_id": item_id,
-            "full_name": repo.full_name,
-            "description": repo.description,
-            "html_url": repo.html_url,
-            "stargazers_count": repo.stargazers_count,
-            "language": repo.language,
+            "full_name": repo["full_name"],
+            "description": repo["description"],
+            "html_url": repo["html_url"],
+            "stargazers_count": repo["stargazers_count"],
+            "language": repo["language"],
         }
     except UnknownObjectException:
         # This repository has been removed.
@@ -593,7 +709,7 @@ def fetch_repo(github_client: Github, item_id: str) -> Optional[dict]:
         return None
 
 
-def fetch_repos(github_client: Github, item_ids: List[str]) -> List[dict]:
+def fetch_repos(github_client: RestGitHub, item_ids: List[str]) -> List[dict]:
     repos = {}
     with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
         futures = [
@@ -640,9 +756,14 @@ def get_neighbors_v2(repo_name: str):
                     gorse_client.get_item(repo_name)
                 except gorse.GorseException as e:
                     if e.status_code == 404:
-                        upsert.delay(current_user.token["access_token"], repo_name.replace(":", "/"))
-
-            github_client = Github(current_user.token["access_token"])
+                        enqueue_once(
+                            upsert,
+                            f"upsert:{repo_name}",
+                            current_user.token["access_token"],
+                            repo_name.replace(":", "/"),
+                        )
+
+            github_client = RestGitHub(current_user.token["access_token"])
             response = Response(
                 json.dumps(
                     {
@@ -669,11 +790,12 @@ def extension_recommend_v2():
             json.dumps({"is_authenticated": False}),
             mimetype="application/json",
         )
+    touch_user()
     try:
         recommended_items = gorse_client.get_recommend(
             current_user.login, n=3, write_back_type="read", write_back_delay="24h"
         )
-        github_client = Github(current_user.token["access_token"])
+        github_client = RestGitHub(current_user.token["access_token"])
         return Response(
             json.dumps(
                 {
@@ -746,5 +868,6 @@ if __name__ == "__main__":
         with app.app_context():
             db.create_all()
             Base.metadata.create_all(bind=db.engine)
+            upgrade_schema(db.engine)
             db.session.commit()
             print("Database tables created")
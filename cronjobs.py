@@ -1,14 +1,15 @@
 import datetime
 import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from threading import Thread
 
 import click
 import requests
 from bs4 import BeautifulSoup
-from github import Github
 from github.GithubException import *
 from gorse import Gorse
-from sqlalchemy import create_engine, or_
+from sqlalchemy import and_, create_engine, or_, text
 from sqlalchemy.orm import sessionmaker
 
 from utils import *
@@ -17,8 +18,11 @@ from utils import *
 logger = get_logger("cronjobs")
 
 # Setup clients
-github_client = Github(os.getenv("GITHUB_ACCESS_TOKEN"))
+token_pool = GitHubTokenPool.from_env()
+github_client = RestGitHub(token_pool)
+graphql_client = GraphQLGitHub(token_pool)
 gorse_client = Gorse(os.getenv("GORSE_ADDRESS"), os.getenv("GORSE_API_KEY"))
+known_items = KnownItems(gorse_client)
 
 # Setup sqlalchemy
 engine = create_engine(os.getenv("SQLALCHEMY_DATABASE_URI"))
@@ -48,99 +52,342 @@ TRENDING_PAGES = [
     "unknown",
 ]
 
+# Hours before a trending repository is enriched again.
+TRENDING_FRESHNESS_HOURS = float(os.getenv("TRENDING_FRESHNESS_HOURS", 24))
+
+# Number of trending pages fetched concurrently.
+TRENDING_WORKERS = 8
+
+
+def get_trending_page(language_page: str) -> List[str]:
+    """
+    Get repositories on a trending page. Failed pages are logged and empty.
+    """
+    try:
+        r = github_session.get("https://github.com/trending/%s" % language_page, timeout=30)
+        r.raise_for_status()
+    except requests.RequestException as e:
+        logger.warning(
+            "failed to get trending page",
+            extra={"tags": {"page": language_page, "exception": str(e)}},
+        )
+        return []
+    soup = BeautifulSoup(r.text, "html.parser")
+    return [article.h2.a["href"][1:] for article in soup.find_all("article")]
+
 
 def get_trending():
     """
     Get trending repositories of C, C++, Go, Python, JS, Java, Rust, TS and unknown.
+    Pages are fetched concurrently and repositories are deduplicated.
     """
-    full_names = []
-    for language_page in TRENDING_PAGES:
-        r = requests.get("https://github.com/trending/%s" % language_page)
-        if r.status_code != 200:
-            return full_names
-        soup = BeautifulSoup(r.text, "html.parser")
-        for article in soup.find_all("article"):
-            full_names.append(article.h2.a["href"][1:])
-    return full_names
+    full_names = {}
+    with ThreadPoolExecutor(TRENDING_WORKERS) as executor:
+        for page_names in executor.map(get_trending_page, TRENDING_PAGES):
+            for full_name in page_names:
+                full_names.setdefault(full_name.lower(), full_name)
+    return list(full_names.values())
 
 
-def insert_trending():
+def insert_trending(freshness_hours: float = TRENDING_FRESHNESS_HOURS):
     """
     Insert trending repositories of C, C++, Go, Python, JS, Java, Rust, TS and unknown.
+    Repositories enriched within freshness_hours are skipped.
     """
     logger.info("start pull trending repos")
     trending_count = 0
     trending_repos = get_trending()
-    for trending_repo in trending_repos:
+    fresh = recently_enriched([full_name.replace("/", ":").lower() for full_name in trending_repos])
+    stale_repos = [
+        full_name for full_name in trending_repos if full_name.replace("/", ":").lower() not in fresh
+    ]
+    logger.info(
+        "skip fresh trending repos",
+        extra={"tags": {"num_repos": len(trending_repos), "num_fresh": len(fresh)}},
+    )
+    for item in EnrichmentPipeline(github_client, graphql_client).run(stale_repos):
         try:
-            item = get_repo_info(github_client, trending_repo)
-            if item is not None:
-                gorse_client.insert_item(item)
-                trending_count += 1
+            gorse_client.insert_item(item)
+            known_items.add([item["ItemId"]])
+            mark_enriched(item["ItemId"], freshness_hours)
+            trending_count += 1
         except Exception as e:
             logger.error(
                 "failed to insert trending repository",
-                extra={"tags": {"repo": trending_repo, "exception": str(e)}},
+                extra={"tags": {"repo": item["ItemId"], "exception": str(e)}},
             )
+    known_items.save()
     logger.info(
         "insert trending repository succeed",
         extra={"tags": {"num_repos": trending_count}},
     )
 
 
-def cleanup_expired_cache():
+def get_row_lock_time(session) -> Optional[int]:
+    """
+    Get accumulated InnoDB row lock wait time in milliseconds, or None if not on MySQL.
+    """
+    if session.bind.dialect.name != "mysql":
+        return None
+    row = session.execute(text("SHOW GLOBAL STATUS LIKE 'Innodb_row_lock_time'")).first()
+    return int(row[1]) if row is not None else None
+
+
+def cleanup_expired_cache(batch_size: int = 1000, pause: float = 0.5):
     """
     Clean up expired KV cache entries.
+
+    Entries are deleted in batches of batch_size walked in (expire, k) order
+    along the expire index, pausing between batches so that writers of
+    kv_cache are never blocked behind a single large transaction.
     """
     session = Session()
+    cutoff = datetime.datetime.utcnow()
+    last_expire, last_k = None, None
+    expired_count, delete_time = 0, 0.0
+    start_time = time.perf_counter()
+    start_lock_time = get_row_lock_time(session)
     try:
-        expired_count = session.query(KvCache).filter(
-            KvCache.expire < datetime.datetime.utcnow()
-        ).delete(synchronize_session=False)
-        session.commit()
-        logger.info(f"Cleaned up {expired_count} expired cache entries")
+        while True:
+            query = session.query(KvCache.k, KvCache.expire).filter(KvCache.expire < cutoff)
+            if last_expire is not None:
+                query = query.filter(
+                    or_(
+                        KvCache.expire > last_expire,
+                        and_(KvCache.expire == last_expire, KvCache.k > last_k),
+                    )
+                )
+            rows = query.order_by(KvCache.expire, KvCache.k).limit(batch_size).all()
+            session.commit()
+            if len(rows) == 0:
+                break
+            last_k, last_expire = rows[-1]
+            # Entries saved again since the batch was read are no longer expired.
+            delete_start = time.perf_counter()
+            expired_count += session.query(KvCache).filter(
+                KvCache.k.in_([k for k, _ in rows]), KvCache.expire < cutoff
+            ).delete(synchronize_session=False)
+            session.commit()
+            delete_time += time.perf_counter() - delete_start
+            if len(rows) < batch_size:
+                break
+            time.sleep(pause)
+        end_lock_time = get_row_lock_time(session)
     except Exception:
         session.rollback()
         raise
     finally:
         session.close()
+    elapsed = time.perf_counter() - start_time
+    lease_count = cleanup_expired_leases(cutoff, batch_size, pause)
+    logger.info(
+        f"Cleaned up {expired_count} expired cache entries and {lease_count} expired leases",
+        extra={
+            "tags": {
+                "rows_per_sec": round(expired_count / delete_time) if delete_time > 0 else 0,
+                "elapsed_sec": round(elapsed, 3),
+                "delete_sec": round(delete_time, 3),
+                "row_lock_wait_ms": end_lock_time - start_lock_time
+                if start_lock_time is not None
+                else None,
+            }
+        },
+    )
 
 
-def insert_trending_entry():
+def cleanup_expired_leases(cutoff: datetime.datetime, batch_size: int, pause: float) -> int:
+    """
+    Delete leases expired before cutoff in batches of batch_size. Leases of
+    enqueue_once are never released, so they pile up without this sweep.
+    Returns the number of deleted leases.
+    """
+    session = Session()
+    deleted_count = 0
     try:
-        insert_trending()
+        while True:
+            keys = [
+                k
+                for k, in session.query(KvLease.k)
+                .filter(KvLease.expire < cutoff)
+                .order_by(KvLease.expire)
+                .limit(batch_size)
+            ]
+            session.commit()
+            if len(keys) == 0:
+                break
+            # Leases taken over since the batch was read are no longer expired.
+            deleted_count += session.query(KvLease).filter(
+                KvLease.k.in_(keys), KvLease.expire < cutoff
+            ).delete(synchronize_session=False)
+            session.commit()
+            if len(keys) < batch_size:
+                break
+            time.sleep(pause)
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+    return deleted_count
+
+
+def cleanup_cache_entry(batch_size: int, pause: float, interval: float):
+    """
+    Sweep expired KV cache entries and leases once, or every interval seconds if interval > 0.
+    """
+    while True:
+        try:
+            cleanup_expired_cache(batch_size, pause)
+        except Exception:
+            logger.exception("failed to clean up expired cache")
+        if interval <= 0:
+            break
+        time.sleep(interval)
+
+
+def insert_trending_entry(freshness_hours: float):
+    try:
+        insert_trending(freshness_hours)
     except Exception as e:
         logger.exception("failed to insert trending repositories")
 
 
-def update_users():
+# Number of users refreshed concurrently by a worker.
+UPDATE_USERS_WORKERS = int(os.getenv("UPDATE_USERS_WORKERS", 4))
+# Refresh intervals of users seen within a period, from the most active.
+USER_REFRESH_TIERS = [
+    (datetime.timedelta(days=1), datetime.timedelta(hours=1)),
+    (datetime.timedelta(days=7), datetime.timedelta(hours=6)),
+    (datetime.timedelta(days=30), datetime.timedelta(days=1)),
+]
+# Refresh interval of dormant users and users never seen.
+USER_DORMANT_REFRESH = datetime.timedelta(days=7)
+# GitHub API requests spent on user refresh per run. 0 means unlimited.
+USER_REFRESH_BUDGET = int(os.getenv("USER_REFRESH_BUDGET", 0))
+
+
+def stale_users_filter(now: datetime.datetime):
+    """
+    Filter users due for refresh. Users never pulled are always due, and the
+    rest are due once their refresh interval for their activity tier passed.
+    """
+    conditions = [User.pulled_at == None, User.pulled_at < now - USER_DORMANT_REFRESH]
+    for seen_within, interval in USER_REFRESH_TIERS:
+        conditions.append(and_(User.seen_at >= now - seen_within, User.pulled_at < now - interval))
+    return or_(*conditions)
+
+
+def claim_users(owner: str, limit: int, lease_seconds: int = USER_LEASE_SECONDS) -> List[int]:
+    """
+    Lease up to limit stale users to owner and return their IDs. New users
+    come first, then the most recently seen. Candidates are picked without
+    locks and then leased by lease_users, so concurrent workers on any node
+    claim disjoint users without blocking each other. Returns an empty list
+    only if no stale user is left unleased.
+    """
+    while True:
+        now = datetime.datetime.utcnow()
+        session = Session()
+        try:
+            candidates = [
+                user_id
+                for user_id, in session.query(User.id)
+                .filter(
+                    stale_users_filter(now),
+                    or_(User.lease_until == None, User.lease_until < now),
+                )
+                .order_by(User.pulled_at.is_(None).desc(), User.seen_at.desc(), User.pulled_at)
+                .limit(limit)
+            ]
+        finally:
+            session.close()
+        if len(candidates) == 0:
+            return []
+        # Candidates leased by other workers meanwhile are skipped next round.
+        user_ids = lease_users(owner, candidates, lease_seconds)
+        if len(user_ids) > 0:
+            return user_ids
+
+
+def update_leased_user(owner: str, user_id: int) -> int:
     """
-    Update user starred repositories.
+    Update a user leased to owner and release the lease. A user that fails
+    keeps the lease until it expires, which backs off retries. Returns the
+    number of GitHub API requests sent.
     """
+    requests_sent = 0
     session = Session()
-    for user in session.query(User).filter(
-        or_(
-            User.pulled_at == None,
-            User.pulled_at < datetime.datetime.utcnow() - datetime.timedelta(days=1),
-        )
-    ):
-        # print(user.login, user.token["access_token"], user.pulled_at)
+    try:
+        user = session.query(User).filter(User.id == user_id, User.lease_owner == owner).one_or_none()
+        if user is None:
+            # The lease expired and was claimed by another worker.
+            return requests_sent
         try:
-            update_user(
-                gorse_client, user.token["access_token"], user.pulled_at)
+            requests_sent = update_user(gorse_client, user, known_items)
             user.pulled_at = datetime.datetime.now()
+            user.lease_owner = None
+            user.lease_until = None
         except BadCredentialsException as e:
             session.delete(user)
             logger.warning(
                 "invalid user token",
                 extra={"tags": {"login": user.login, "exception": str(e)}},
             )
+        except Exception:
+            logger.exception(
+                "failed to update user", extra={"tags": {"login": user.login}}
+            )
         session.commit()
+        return requests_sent
+    finally:
+        session.close()
+
 
+def update_users(
+    workers: int = UPDATE_USERS_WORKERS,
+    lease_seconds: int = USER_LEASE_SECONDS,
+    budget: int = USER_REFRESH_BUDGET,
+):
+    """
+    Update user starred repositories. Stale users are leased in batches and
+    refreshed on a bounded pool, and leases are renewed while they run, so
+    any number of workers can run this at the same time. No more users are
+    claimed once budget GitHub API requests were sent, unless budget is 0.
+    """
+    owner = uuid.uuid4().hex
+    in_flight = {}
+    exhausted = False
+    spent, num_users = 0, 0
+    renewed_at = time.time()
+    with ThreadPoolExecutor(workers) as executor:
+        while True:
+            if budget > 0 and spent >= budget and not exhausted:
+                logger.info("user refresh budget spent", extra={"tags": {"requests": spent}})
+                exhausted = True
+            if not exhausted and len(in_flight) < workers:
+                user_ids = claim_users(owner, workers - len(in_flight), lease_seconds)
+                exhausted = len(user_ids) == 0
+                for user_id in user_ids:
+                    in_flight[executor.submit(update_leased_user, owner, user_id)] = user_id
+            if len(in_flight) == 0:
+                break
+            done, _ = wait(in_flight, timeout=lease_seconds / 3, return_when=FIRST_COMPLETED)
+            for future in done:
+                user_id = in_flight.pop(future)
+                try:
+                    spent += future.result()
+                    num_users += 1
+                except Exception:
+                    logger.exception("failed to update user", extra={"tags": {"user_id": user_id}})
+            if time.time() - renewed_at > lease_seconds / 3 and len(in_flight) > 0:
+                renew_user_leases(owner, list(in_flight.values()), lease_seconds)
+                renewed_at = time.time()
+    logger.info("update users", extra={"tags": {"num_users": num_users, "requests": spent}})
 
-def insert_users_entry():
+
+def insert_users_entry(budget: int):
     try:
-        update_users()
+        update_users(budget=budget)
     except:
         logger.exception("failed to update user labels and feedback")
 
@@ -149,15 +396,42 @@ def insert_users_entry():
 @click.option("--update-users", is_flag=True)
 @click.option("--insert-trending", is_flag=True)
 @click.option("--cleanup-cache", is_flag=True)
-def main(update_users: bool, insert_trending: bool, cleanup_cache: bool):
+@click.option("--cleanup-batch-size", default=1000, help="Number of cache entries deleted per batch.")
+@click.option("--cleanup-pause", default=0.5, help="Seconds to pause between cleanup batches.")
+@click.option("--cleanup-interval", default=0.0, help="Keep sweeping the cache every N seconds. 0 sweeps once.")
+@click.option(
+    "--trending-freshness-hours",
+    default=TRENDING_FRESHNESS_HOURS,
+    help="Skip trending repositories enriched within N hours.",
+)
+@click.option(
+    "--user-refresh-budget",
+    default=USER_REFRESH_BUDGET,
+    help="Stop refreshing users after N GitHub API requests. 0 is unlimited.",
+)
+def main(
+    update_users: bool,
+    insert_trending: bool,
+    cleanup_cache: bool,
+    cleanup_batch_size: int,
+    cleanup_pause: float,
+    cleanup_interval: float,
+    trending_freshness_hours: float,
+    user_refresh_budget: int,
+):
     threads = []
     run_all = update_users is False and insert_trending is False and cleanup_cache is False
     if run_all or insert_trending:
-        threads.append(Thread(target=insert_trending_entry))
+        threads.append(Thread(target=insert_trending_entry, args=(trending_freshness_hours,)))
     if run_all or update_users:
-        threads.append(Thread(target=insert_users_entry))
+        threads.append(Thread(target=insert_users_entry, args=(user_refresh_budget,)))
     if run_all or cleanup_cache:
-        threads.append(Thread(target=cleanup_expired_cache))
+        threads.append(
+            Thread(
+                target=cleanup_cache_entry,
+                args=(cleanup_batch_size, cleanup_pause, cleanup_interval),
+            )
+        )
     for thread in threads:
         thread.start()
     for thread in threads:
@@ -1,7 +1,13 @@
 import datetime
+import json
 import os
+import socket
+import threading
+import time
+from concurrent.futures import Future
 
 from celery import Celery
+from celery.signals import before_task_publish, task_prerun, worker_shutdown
 from github import Github
 from github.GithubException import *
 from gorse import Gorse
@@ -16,11 +22,136 @@ logger = get_logger("jobs")
 
 # Setup client
 gorse_client = Gorse(os.getenv("GORSE_ADDRESS"), os.getenv("GORSE_API_KEY"))
+known_items = KnownItems(gorse_client)
 
 
 # Setup celery
 app = Celery("jobs", broker=os.getenv("BROKER_ADDRESS"))
 
+# Queues from the most to the least urgent, each served by dedicated workers
+# (celery -A jobs worker -Q <queue>), so a first pull at login never waits
+# behind upserts.
+LOGIN_QUEUE = "login"
+INTERACTIVE_QUEUE = "interactive"
+QUEUES = [LOGIN_QUEUE, INTERACTIVE_QUEUE]
+
+app.conf.task_default_queue = INTERACTIVE_QUEUE
+app.conf.task_routes = {
+    "jobs.pull": {"queue": LOGIN_QUEUE},
+    "jobs.upsert": {"queue": INTERACTIVE_QUEUE},
+}
+
+# Minimum seconds between saves of queue wait stats of a worker process.
+QUEUE_STATS_SAVE_INTERVAL = 10
+
+
+class QueueWaitStats:
+    """
+    Time tasks of each queue waited between publish and start in this worker
+    process. Stats are saved to kv_cache under queue_stats:<queue>:<worker>
+    every QUEUE_STATS_SAVE_INTERVAL seconds by a background thread and at
+    worker shutdown, and merged across workers by get_queue_stats.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__stats = {}
+        self.__dirty = False
+        self.__saver = None
+
+    def record(self, queue: str, wait: float):
+        with self.__lock:
+            stats = self.__stats.setdefault(queue, {"count": 0, "total": 0.0, "max": 0.0, "last": 0.0})
+            stats["count"] += 1
+            stats["total"] += wait
+            stats["max"] = max(stats["max"], wait)
+            stats["last"] = wait
+            self.__dirty = True
+            if self.__saver is None:
+                self.__saver = threading.Thread(target=self.__save_forever, daemon=True)
+                self.__saver.start()
+
+    def __save_forever(self):
+        while True:
+            time.sleep(QUEUE_STATS_SAVE_INTERVAL)
+            try:
+                self.save()
+            except SQLAlchemyError:
+                logger.exception("failed to save queue stats")
+
+    def save(self):
+        """Save stats recorded since the last save."""
+        with self.__lock:
+            if not self.__dirty:
+                return
+            self.__dirty = False
+            snapshot = {queue: dict(stats) for queue, stats in self.__stats.items()}
+        worker = f"{socket.gethostname()}:{os.getpid()}"
+        for queue, stats in snapshot.items():
+            save_cache(f"queue_stats:{queue}:{worker}", stats, expiry_hours=24)
+
+
+queue_wait_stats = QueueWaitStats()
+
+
+@before_task_publish.connect
+def stamp_enqueued_at(headers=None, **kwargs):
+    # Picked up by record_queue_wait in the worker.
+    if headers is not None:
+        headers["enqueued_at"] = time.time()
+
+
+@task_prerun.connect
+def record_queue_wait(task=None, **kwargs):
+    enqueued_at = getattr(task.request, "enqueued_at", None)
+    delivery_info = task.request.delivery_info or {}
+    queue = delivery_info.get("routing_key") or delivery_info.get("exchange") or app.conf.task_default_queue
+    if enqueued_at is not None:
+        queue_wait_stats.record(queue, time.time() - enqueued_at)
+
+
+@worker_shutdown.connect
+def save_queue_wait_stats(**kwargs):
+    try:
+        queue_wait_stats.save()
+    except SQLAlchemyError:
+        logger.exception("failed to save queue stats")
+
+
+def get_queue_stats() -> Dict[str, Dict]:
+    """
+    Get depth and wait time stats of each queue. Depth is the number of
+    messages waiting in the broker, and wait times (seconds) are merged
+    across workers.
+    """
+    stats = {queue: {"depth": None, "count": 0, "mean_wait": None, "max_wait": 0.0} for queue in QUEUES}
+    with app.connection_for_read() as conn:
+        channel = conn.default_channel
+        for queue in QUEUES:
+            try:
+                stats[queue]["depth"] = channel.queue_declare(queue, passive=True).message_count
+            except Exception:
+                # The queue doesn't exist until a worker or a task declares it.
+                stats[queue]["depth"] = 0
+    session = get_session()
+    try:
+        rows = session.query(KvCache).filter(
+            KvCache.k.like("queue_stats:%"), KvCache.expire > datetime.datetime.utcnow()
+        )
+        for row in rows:
+            queue = row.k.split(":")[1]
+            if queue not in stats:
+                continue
+            worker_stats = json.loads(decode_cache_value(row.v))
+            total = (stats[queue]["mean_wait"] or 0.0) * stats[queue]["count"] + worker_stats["total"]
+            stats[queue]["count"] += worker_stats["count"]
+            stats[queue]["max_wait"] = max(stats[queue]["max_wait"], worker_stats["max"])
+            if stats[queue]["count"] > 0:
+                stats[queue]["mean_wait"] = total / stats[queue]["count"]
+    finally:
+        session.close()
+    return stats
+
 # Setup sqlalchemy
 engine = create_engine(os.getenv("SQLALCHEMY_DATABASE_URI"))
 Session = sessionmaker()
@@ -36,27 +167,151 @@ def pull(token: str):
         # Fetch user record
         session = Session()
         user = session.query(User).filter(User.login == login).one()
+        # Take the lease of cronjobs.update_users, so that a user is never
+        # refreshed by both at once.
+        owner = uuid.uuid4().hex
+        if len(lease_users(owner, [user.id])) == 0:
+            logger.info("skip user being refreshed", extra={"tags": {"login": login}})
+            return
+        session.refresh(user)
+        done = threading.Event()
+
+        def renew():
+            while not done.wait(USER_LEASE_SECONDS / 3):
+                try:
+                    renew_user_leases(owner, [user.id])
+                except SQLAlchemyError:
+                    logger.exception("failed to renew user lease")
+
+        threading.Thread(target=renew, daemon=True).start()
         try:
-            update_user(
-                gorse_client, user.token["access_token"], user.pulled_at)
+            update_user(gorse_client, user, known_items)
             user.pulled_at = datetime.datetime.now()
+            user.lease_owner = None
+            user.lease_until = None
         except BadCredentialsException as e:
             session.delete(user)
             logger.warning(
                 "invalid user token",
                 extra={"tags": {"login": user.login, "exception": str(e)}},
             )
+        finally:
+            done.set()
         session.commit()
     except Exception as e:
         logger.exception("failed to update user labels and feedback")
 
 
+# Hours an upserted repository is not upserted again.
+UPSERT_FRESHNESS_HOURS = float(os.getenv("UPSERT_FRESHNESS_HOURS", 24))
+# Maximum number of upserts enriched together. Batches only fill up if the
+# worker runs at least as many tasks concurrently (see docker-compose.yml).
+UPSERT_BATCH_SIZE = int(os.getenv("UPSERT_BATCH_SIZE", 16))
+# Seconds the first upsert of a batch waits for more.
+UPSERT_BATCH_WINDOW = float(os.getenv("UPSERT_BATCH_WINDOW", 2))
+
+
+def upsert_batch(upserts: List[Tuple[str, str]]) -> Dict[str, str]:
+    """
+    Upsert repositories requested as (token, full_name) in one batch. Each
+    repository is fetched with the token of its first requester, never with
+    the token of another user who might see private repositories. Metadata
+    is fetched in bulk per token, descriptions are embedded in batches and
+    items are inserted in one request. Returns the outcome by item ID: SKIP,
+    UPSERT or IGNORE.
+    """
+    full_names, requesters = {}, {}
+    for token, full_name in upserts:
+        item_id = full_name.replace("/", ":").lower()
+        full_names.setdefault(item_id, full_name)
+        requesters.setdefault(item_id, token)
+    # Drop duplicates of recently completed upserts.
+    fresh = recently_enriched(list(full_names))
+    outcomes = {item_id: "SKIP" if item_id in fresh else "IGNORE" for item_id in full_names}
+    stale_names = {}
+    for item_id, full_name in full_names.items():
+        if item_id not in fresh:
+            stale_names.setdefault(requesters[item_id], []).append(full_name)
+    if len(stale_names) == 0:
+        return outcomes
+    items = []
+    for token, names in stale_names.items():
+        tokens = GitHubTokenPool([token], wait=False)
+        items.extend(EnrichmentPipeline(RestGitHub(tokens), GraphQLGitHub(tokens)).run(names))
+    if len(items) > 0:
+        insert_items(gorse_client, items)
+        known_items.add([item["ItemId"] for item in items])
+        for item in items:
+            outcomes[item["ItemId"]] = "UPSERT"
+            mark_enriched(item["ItemId"], UPSERT_FRESHNESS_HOURS)
+    logger.info(
+        "upsert batch",
+        extra={
+            "tags": {
+                "num_upserts": len(upserts),
+                "num_tokens": len(stale_names),
+                "num_repos": sum(len(names) for names in stale_names.values()),
+                "num_items": len(items),
+            }
+        },
+    )
+    return outcomes
+
+
+class UpsertBatcher:
+    """
+    Aggregate upserts of tasks running concurrently in this worker. The oldest
+    pending upsert leads a batch: it waits up to window seconds or until
+    batch_size upserts are pending, then runs upsert_batch for at most
+    batch_size of them, while the others wait for its outcome. Upserts left
+    over are led by the oldest of them once the batch is taken. Aggregation
+    needs a pool running many tasks per process (celery worker --pool threads).
+    """
+
+    def __init__(self, batch_size: int = UPSERT_BATCH_SIZE, window: float = UPSERT_BATCH_WINDOW):
+        self.batch_size = batch_size
+        self.window = window
+        self.__cond = threading.Condition()
+        self.__pending = []
+        self.__leading = False
+
+    def upsert(self, token: str, full_name: str) -> str:
+        """Upsert a repository in a batch and return its outcome."""
+        future = Future()
+        entry = (token, full_name, future)
+        batch = None
+        with self.__cond:
+            self.__pending.append(entry)
+            if len(self.__pending) >= self.batch_size:
+                self.__cond.notify_all()
+            # Wait until taken into a batch, or until leading one.
+            while entry in self.__pending:
+                if not self.__leading and self.__pending[0] is entry:
+                    self.__leading = True
+                    deadline = time.time() + self.window
+                    while len(self.__pending) < self.batch_size and time.time() < deadline:
+                        self.__cond.wait(deadline - time.time())
+                    batch = self.__pending[: self.batch_size]
+                    self.__pending = self.__pending[self.batch_size :]
+                    self.__leading = False
+                    # Let the oldest upsert left over lead the next batch.
+                    self.__cond.notify_all()
+                    break
+                self.__cond.wait()
+        if batch is not None:
+            try:
+                outcomes = upsert_batch([(token, full_name) for token, full_name, _ in batch])
+                for _, full_name, pending in batch:
+                    pending.set_result(outcomes[full_name.replace("/", ":").lower()])
+            except Exception as e:
+                for _, _, pending in batch:
+                    pending.set_exception(e)
+        return future.result()
+
+
+upsert_batcher = UpsertBatcher()
+
+
 @app.task
 def upsert(token: str, full_name: str):
-    github_client = Github(token)
-    item = get_repo_info(github_client, full_name)
-    if item is not None:
-        gorse_client.insert_item(item)
-        print("UPSERT " + full_name)
-    else:
-        print("IGNORE " + full_name)
+    print(upsert_batcher.upsert(token, full_name) + " " + full_name)
@@ -1,20 +1,31 @@
+import base64
 import datetime
+import functools
+import gzip
+import hashlib
 import json
 import logging
 import os
 import re
+import struct
 import sys
-from typing import List, Optional, Tuple, Dict, Any
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 
 import pytz
 import requests
 from dateutil import parser
-from github import Github
 from github.GithubException import *
 from gorse import Gorse, GorseException
-from sqlalchemy import Column, String, Integer, DateTime, JSON, Text
-from sqlalchemy.dialects.mysql import LONGTEXT
-from sqlalchemy.orm import declarative_base
+from sqlalchemy import Column, String, Integer, DateTime, JSON, LargeBinary, create_engine, insert, inspect, or_, text
+from sqlalchemy.dialects.mysql import LONGBLOB
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.orm import declarative_base, sessionmaker
 from openai import OpenAI
 from pydantic import BaseModel
 
@@ -76,7 +87,14 @@ class User(Base):
     token = Column(JSON)
     login = Column(String)
     pulled_at = Column(DateTime)
-
+    # Number of starred repositories and time of the newest star at the last pull.
+    starred_count = Column(Integer)
+    starred_at = Column(DateTime)
+    # Worker refreshing the user and until when, see lease_users.
+    lease_owner = Column(String(32))
+    lease_until = Column(DateTime)
+    # Last time the user was seen using GitRec, see app.touch_user.
+    seen_at = Column(DateTime, index=True)
 
 
 class KvCache(Base):
@@ -84,8 +102,14 @@ class KvCache(Base):
     __tablename__ = 'kv_cache'
 
     k = Column(String(256), primary_key=True)
-    v = Column(Text().with_variant(LONGTEXT, "mysql"), nullable=False)
-    expire = Column(DateTime, nullable=False)
+    # Serialized JSON encoded by encode_cache_value.
+    v = Column(LargeBinary().with_variant(LONGBLOB, "mysql"), nullable=False)
+    expire = Column(DateTime, nullable=False, index=True)
+    # Soft expiry. Between refresh_at and expire the entry is served stale
+    # while it is refreshed in the background. NULL means refresh_at == expire.
+    refresh_at = Column(DateTime)
+    # SHA-256 of the serialized JSON, used as a strong HTTP ETag.
+    etag = Column(String(64))
 
     DEFAULT_EXPIRY_HOURS = 24
 
@@ -94,79 +118,841 @@ class KvCache(Base):
         return self.expire < datetime.datetime.utcnow()
 
 
-def get_cached(k: str) -> Optional[Any]:
-    """Get cached data by key. Returns None if not found or expired."""
-    from sqlalchemy import create_engine
-    from sqlalchemy.orm import sessionmaker
+class EmbeddingCache(Base):
+    """Embedding model for storing vectors of texts by content hash."""
+    __tablename__ = 'embedding_cache'
+
+    # SHA-256 of model, dimensions and text (see embedding_digest).
+    digest = Column(String(64), primary_key=True)
+    model = Column(String(64), nullable=False)
+    dimensions = Column(Integer, nullable=False)
+    # Vector packed by pack_vector.
+    vector = Column(LargeBinary, nullable=False)
+    created_at = Column(DateTime, nullable=False)
+
+
+class KvLease(Base):
+    """Lease model for electing a single worker to fill a cache key."""
+    __tablename__ = 'kv_lease'
+
+    k = Column(String(256), primary_key=True)
+    owner = Column(String(32), nullable=False)
+    expire = Column(DateTime, nullable=False, index=True)
+
+
+_engine = None
+_engine_lock = threading.Lock()
+_Session = sessionmaker()
+
+
+def get_engine():
+    """
+    Get the process-wide SQLAlchemy engine. Connections are pooled and reused
+    across requests instead of opening a new connection per cache lookup.
+    """
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = create_engine(
+                    os.getenv("SQLALCHEMY_DATABASE_URI"),
+                    pool_pre_ping=True,
+                    pool_recycle=3600,
+                )
+    return _engine
+
+
+def get_session():
+    """Create a session bound to the process-wide engine."""
+    return _Session(bind=get_engine())
+
+
+class MemoryCache:
+    """
+    Bounded in-process LRU cache with per-entry TTL, sized by bytes.
+    """
+
+    def __init__(self, max_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # key -> (value, size in bytes, monotonic deadline)
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, k: str) -> Optional[Any]:
+        with self.__lock:
+            entry = self.__entries.get(k)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, size, deadline = entry
+            if deadline < time.monotonic():
+                self.__remove(k)
+                self.misses += 1
+                return None
+            self.__entries.move_to_end(k)
+            self.hits += 1
+            return value
 
-    engine = create_engine(os.getenv("SQLALCHEMY_DATABASE_URI"))
-    Session = sessionmaker()
-    Session.configure(bind=engine)
-    session = Session()
+    def set(self, k: str, v: Any, size: int, expire: datetime.datetime) -> None:
+        """Insert an entry. It lives until the memory TTL or the database expiry, whichever comes first."""
+        if size > self.max_bytes:
+            self.delete(k)
+            return
+        remaining = (expire - datetime.datetime.utcnow()).total_seconds()
+        deadline = time.monotonic() + min(self.ttl, remaining)
+        with self.__lock:
+            if k in self.__entries:
+                self.__remove(k)
+            self.__entries[k] = (v, size, deadline)
+            self.num_bytes += size
+            while self.num_bytes > self.max_bytes:
+                oldest = next(iter(self.__entries))
+                self.__remove(oldest)
+                self.evictions += 1
 
+    def delete(self, k: str) -> None:
+        with self.__lock:
+            if k in self.__entries:
+                self.__remove(k)
+
+    def stats(self) -> Dict[str, int]:
+        with self.__lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.__entries),
+                "bytes": self.num_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+    def __remove(self, k: str) -> None:
+        _, size, _ = self.__entries.pop(k)
+        self.num_bytes -= size
+
+
+# In-process tier in front of the kv_cache table. Entries are bounded by
+# KV_CACHE_MEMORY_TTL seconds so workers converge after another worker writes.
+memory_cache = MemoryCache(
+    max_bytes=int(os.getenv("KV_CACHE_MEMORY_BYTES", 64 * 1024 * 1024)),
+    ttl=float(os.getenv("KV_CACHE_MEMORY_TTL", 300)),
+)
+
+# Counters of lookups that fell through to the kv_cache table.
+database_cache_stats = {"hits": 0, "misses": 0}
+
+
+def get_cache_stats() -> Dict[str, Dict[str, int]]:
+    """Get hit/miss/eviction counters of both cache tiers."""
+    return {"memory": memory_cache.stats(), "database": dict(database_cache_stats)}
+
+
+# Codecs for kv_cache values: name -> (id, encode, decode).
+CACHE_CODECS = {
+    "json": (0, lambda data: data, lambda data: data),
+    "zlib": (1, lambda data: zlib.compress(data, 6), zlib.decompress),
+    # gzip payloads can be sent as HTTP bodies with Content-Encoding: gzip.
+    "gzip": (2, lambda data: gzip.compress(data, 6, mtime=0), gzip.decompress),
+}
+
+# Encoded values start with this magic followed by the codec id. Plain JSON
+# written before codecs existed never starts with a NUL byte.
+CACHE_CODEC_MAGIC = b"\x00KV"
+
+KV_CACHE_CODEC = os.getenv("KV_CACHE_CODEC", "gzip")
+
+
+def encode_cache_value(data: bytes, codec: str = KV_CACHE_CODEC) -> bytes:
+    """Encode serialized JSON with a codec and prepend the codec header."""
+    codec_id, encode, _ = CACHE_CODECS[codec]
+    return CACHE_CODEC_MAGIC + bytes([codec_id]) + encode(data)
+
+
+def split_cache_value(blob) -> Tuple[str, bytes]:
+    """Split a kv_cache value into its codec name and encoded payload."""
+    if isinstance(blob, str):
+        return "json", blob.encode("utf-8")
+    if not blob.startswith(CACHE_CODEC_MAGIC):
+        return "json", bytes(blob)
+    codec_id = blob[len(CACHE_CODEC_MAGIC)]
+    for codec, (cid, _, _) in CACHE_CODECS.items():
+        if cid == codec_id:
+            return codec, blob[len(CACHE_CODEC_MAGIC) + 1:]
+    raise ValueError("unknown cache codec %d" % codec_id)
+
+
+def decode_cache_value(blob) -> bytes:
+    """Decode a kv_cache value back to serialized JSON. Accepts legacy plain JSON rows."""
+    codec, payload = split_cache_value(blob)
+    _, _, decode = CACHE_CODECS[codec]
+    return decode(payload)
+
+
+class CacheEntry:
+    """A decoded cache value with its soft expiry, encoded body and ETag."""
+
+    def __init__(self, value: Any, refresh_at: datetime.datetime, blob: bytes, etag: str):
+        self.value = value
+        self.refresh_at = refresh_at
+        self.blob = blob
+        self.etag = etag
+
+    def is_stale(self) -> bool:
+        """Check if the entry has passed its soft expiry."""
+        return self.refresh_at < datetime.datetime.utcnow()
+
+
+def load_cached_entry(k: str) -> Optional[CacheEntry]:
+    """Get cache entry by key from memory or database. Returns None if not found or expired."""
+    entry = memory_cache.get(k)
+    if entry is not None:
+        return entry
+
+    session = get_session()
     try:
         cache = session.query(KvCache).filter(KvCache.k == k).first()
         if cache and not cache.is_expired():
-            return json.loads(cache.v)
+            data = decode_cache_value(cache.v)
+            entry = CacheEntry(
+                json.loads(data),
+                cache.refresh_at or cache.expire,
+                bytes(cache.v),
+                cache.etag or hashlib.sha256(data).hexdigest(),
+            )
+            memory_cache.set(k, entry, len(data) + len(cache.v), cache.expire)
+            database_cache_stats["hits"] += 1
+            return entry
+        database_cache_stats["misses"] += 1
         return None
     finally:
         session.close()
 
 
-def save_cache(k: str, v: Any, expiry_hours: int = KvCache.DEFAULT_EXPIRY_HOURS) -> None:
-    """Save data to cache with optional expiry time in hours."""
-    from sqlalchemy import create_engine
-    from sqlalchemy.orm import sessionmaker
+def get_cached_entry(k: str, refresh: Optional[Callable[[], Any]] = None) -> Optional[CacheEntry]:
+    """
+    Get cache entry by key. Returns None if not found or expired.
+
+    Stale entries are returned immediately if refresh is given, and refresh
+    is called in the background to save a new value. Without refresh,
+    stale entries are treated as missing.
+    """
+    entry = load_cached_entry(k)
+    if entry is None:
+        return None
+    if entry.is_stale():
+        if refresh is None:
+            return None
+        refresh_in_background(k, refresh)
+    return entry
+
+
+def get_cached(k: str, refresh: Optional[Callable[[], Any]] = None) -> Optional[Any]:
+    """Get cached data by key. Returns None if not found or expired. See get_cached_entry."""
+    entry = get_cached_entry(k, refresh)
+    if entry is None:
+        return None
+    return entry.value
+
 
-    engine = create_engine(os.getenv("SQLALCHEMY_DATABASE_URI"))
-    Session = sessionmaker()
-    Session.configure(bind=engine)
-    session = Session()
+def save_cache(
+    k: str,
+    v: Any,
+    expiry_hours: int = KvCache.DEFAULT_EXPIRY_HOURS,
+    stale_hours: int = 0,
+) -> None:
+    """
+    Save data to cache with optional expiry time in hours.
+
+    The entry becomes stale after expiry_hours and is dropped stale_hours later.
+    """
+    session = get_session()
 
     try:
+        data = json.dumps(v).encode("utf-8")
+        blob = encode_cache_value(data)
+        # Strong ETag of the serialized body, computed once per write.
+        etag = hashlib.sha256(data).hexdigest()
         cache = session.query(KvCache).filter(KvCache.k == k).first()
-        expire_time = datetime.datetime.utcnow() + datetime.timedelta(hours=expiry_hours)
+        refresh_time = datetime.datetime.utcnow() + datetime.timedelta(hours=expiry_hours)
+        expire_time = refresh_time + datetime.timedelta(hours=stale_hours)
         if cache:
-            cache.v = json.dumps(v)
+            cache.v = blob
             cache.expire = expire_time
+            cache.refresh_at = refresh_time
+            cache.etag = etag
         else:
-            cache = KvCache(k=k, v=json.dumps(v), expire=expire_time)
+            cache = KvCache(
+                k=k, v=blob, expire=expire_time, refresh_at=refresh_time, etag=etag
+            )
             session.add(cache)
         session.commit()
+        memory_cache.set(
+            k, CacheEntry(v, refresh_time, blob, etag), len(data) + len(blob), expire_time
+        )
     except Exception:
         session.rollback()
+        memory_cache.delete(k)
         raise
     finally:
         session.close()
 
+
+def upgrade_schema(engine) -> None:
+    """
+    Add columns and indexes declared in models but missing from existing
+    tables, and convert text columns that are now declared binary.
+    """
+    inspector = inspect(engine)
+    preparer = engine.dialect.identifier_preparer
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            columns = {
+                column["name"]: column["type"]
+                for column in inspector.get_columns(table.name)
+            }
+            for column in table.columns:
+                if (
+                    column.name in columns
+                    and engine.dialect.name == "mysql"
+                    and isinstance(column.type, LargeBinary)
+                    and isinstance(columns[column.name], String)
+                ):
+                    # Convert text columns to blobs in place, e.g. kv_cache.v.
+                    conn.execute(
+                        text(
+                            "ALTER TABLE %s MODIFY COLUMN %s %s%s"
+                            % (
+                                preparer.quote(table.name),
+                                preparer.quote(column.name),
+                                column.type.compile(dialect=engine.dialect),
+                                "" if column.nullable else " NOT NULL",
+                            )
+                        )
+                    )
+                    logger.info(
+                        "convert column to binary",
+                        extra={"tags": {"table": table.name, "column": column.name}},
+                    )
+                elif column.name not in columns:
+                    conn.execute(
+                        text(
+                            "ALTER TABLE %s ADD COLUMN %s %s"
+                            % (
+                                preparer.quote(table.name),
+                                preparer.quote(column.name),
+                                column.type.compile(dialect=engine.dialect),
+                            )
+                        )
+                    )
+                    logger.info(
+                        "add column",
+                        extra={"tags": {"table": table.name, "column": column.name}},
+                    )
+            indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in indexes:
+                    index.create(conn)
+                    logger.info(
+                        "add index",
+                        extra={"tags": {"table": table.name, "index": index.name}},
+                    )
+
+
+def acquire_lease(k: str, seconds: int) -> Optional[str]:
+    """
+    Acquire a lease on a key shared by all workers.
+
+    Returns the owner token if acquired, or None if another worker holds an unexpired lease.
+    """
+    owner = uuid.uuid4().hex
+    now = datetime.datetime.utcnow()
+    expire_time = now + datetime.timedelta(seconds=seconds)
+    session = get_session()
+    try:
+        try:
+            session.add(KvLease(k=k, owner=owner, expire=expire_time))
+            session.commit()
+            return owner
+        except IntegrityError:
+            session.rollback()
+        # Take over the lease if its holder is gone.
+        count = (
+            session.query(KvLease)
+            .filter(KvLease.k == k, KvLease.expire < now)
+            .update({"owner": owner, "expire": expire_time}, synchronize_session=False)
+        )
+        session.commit()
+        return owner if count == 1 else None
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def release_lease(k: str, owner: str) -> None:
+    """Release a lease acquired by acquire_lease."""
+    session = get_session()
+    try:
+        session.query(KvLease).filter(KvLease.k == k, KvLease.owner == owner).delete(
+            synchronize_session=False
+        )
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+# Seconds a user is leased to a worker refreshing it before others may claim it.
+USER_LEASE_SECONDS = int(os.getenv("USER_LEASE_SECONDS", 600))
+
+
+def lease_users(owner: str, user_ids: List[int], lease_seconds: int = USER_LEASE_SECONDS) -> List[int]:
+    """
+    Lease users not leased to another worker to owner, with a conditional
+    UPDATE that only locks the given rows. Returns the IDs leased to owner.
+    """
+    now = datetime.datetime.utcnow()
+    session = get_session()
+    try:
+        session.query(User).filter(
+            User.id.in_(user_ids), or_(User.lease_until == None, User.lease_until < now)
+        ).update(
+            {
+                User.lease_owner: owner,
+                User.lease_until: now + datetime.timedelta(seconds=lease_seconds),
+            },
+            synchronize_session=False,
+        )
+        session.commit()
+        return [
+            user_id
+            for user_id, in session.query(User.id).filter(User.id.in_(user_ids), User.lease_owner == owner)
+        ]
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def renew_user_leases(owner: str, user_ids: List[int], lease_seconds: int = USER_LEASE_SECONDS):
+    """
+    Extend leases of users still being refreshed by owner.
+    """
+    session = get_session()
+    try:
+        session.query(User).filter(User.id.in_(user_ids), User.lease_owner == owner).update(
+            {User.lease_until: datetime.datetime.utcnow() + datetime.timedelta(seconds=lease_seconds)},
+            synchronize_session=False,
+        )
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+class _Flight:
+    """A computation in progress that concurrent callers wait on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+_flights: Dict[str, _Flight] = {}
+_flights_lock = threading.Lock()
+
+# Seconds a worker may spend filling a cache key before others take over.
+SINGLE_FLIGHT_LEASE_SECONDS = 30
+
+
+def single_flight(k: str, fn: Callable[[], Any], lease_seconds: int = SINGLE_FLIGHT_LEASE_SECONDS) -> Any:
+    """
+    Fill a cache key once while concurrent callers wait for the result.
+
+    fn computes the value, saves it under k and returns it. Greenlets in the
+    same worker share the result of a single call. Across workers, the one
+    holding the lease calls fn while the others poll the cache until the
+    value appears or the lease is released.
+    """
+    with _flights_lock:
+        flight = _flights.get(k)
+        leader = flight is None
+        if leader:
+            flight = _flights[k] = _Flight()
+    if not leader:
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    try:
+        flight.result = _fill_once(k, fn, lease_seconds)
+        return flight.result
+    except Exception as e:
+        flight.error = e
+        raise
+    finally:
+        with _flights_lock:
+            del _flights[k]
+        flight.done.set()
+
+
+def _fill_once(k: str, fn: Callable[[], Any], lease_seconds: int) -> Any:
+    while True:
+        try:
+            owner = acquire_lease(k, lease_seconds)
+        except SQLAlchemyError:
+            logger.warning("failed to acquire lease", extra={"tags": {"key": k}})
+            return fn()
+        if owner is not None:
+            try:
+                # Another worker may have filled the key before releasing its lease.
+                value = get_cached(k)
+                if value is not None:
+                    return value
+                return fn()
+            finally:
+                release_lease(k, owner)
+        time.sleep(0.1)
+        value = get_cached(k)
+        if value is not None:
+            return value
+
+
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+
+def refresh_in_background(k: str, fn: Callable[[], Any]) -> None:
+    """
+    Call fn in a background thread (a greenlet under gevent) to refresh a
+    stale cache key. At most one refresh per key runs at a time across all
+    workers, and workers skip the refresh if another one already saved a
+    fresh entry.
+    """
+    with _refreshing_lock:
+        if k in _refreshing:
+            return
+        _refreshing.add(k)
+
+    def refresh():
+        try:
+            # The stale entry is dropped so that the next read sees the database.
+            memory_cache.delete(k)
+            owner = acquire_lease(k, SINGLE_FLIGHT_LEASE_SECONDS)
+            if owner is None:
+                # Another worker is refreshing this key.
+                return
+            try:
+                entry = load_cached_entry(k)
+                if entry is not None and not entry.is_stale():
+                    # Another worker refreshed this key meanwhile.
+                    return
+                fn()
+            finally:
+                release_lease(k, owner)
+        except Exception:
+            logger.exception("failed to refresh cache", extra={"tags": {"key": k}})
+        finally:
+            with _refreshing_lock:
+                _refreshing.discard(k)
+
+    threading.Thread(target=refresh, daemon=True).start()
+
+
+# GitHub caps GraphQL connections at 100 nodes per page.
+GRAPHQL_MAX_PAGE_SIZE = 100
+
+# Seconds before a GitHub request times out, the same as PyGithub's default.
+GITHUB_TIMEOUT = 15
+
+# Keep-alive session shared by all GitHub clients.
+github_session = requests.Session()
+github_session.mount(
+    "https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=32)
+)
+
+
+class GitHubTokenPool:
+    """
+    Pool of GitHub tokens. The rate limit of each token is tracked per
+    resource (core, graphql, search) from response headers, and each call
+    is routed to the token with the most remaining requests.
+
+    If all tokens are exhausted, acquire blocks until the earliest reset
+    when wait is True, and raises RateLimitExceededException otherwise.
+    """
+
+    def __init__(self, tokens: List[Optional[str]], wait: bool = True):
+        self.tokens = tokens
+        self.wait = wait
+        # Number of requests sent through the pool.
+        self.requests = 0
+        # (token, resource) -> (remaining, reset timestamp)
+        self.__limits = {}
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def from_env() -> "GitHubTokenPool":
+        """
+        Create a pool of service tokens from GITHUB_ACCESS_TOKENS (comma
+        separated), falling back to GITHUB_ACCESS_TOKEN.
+        """
+        tokens = [
+            token.strip()
+            for token in os.getenv("GITHUB_ACCESS_TOKENS", "").split(",")
+            if token.strip()
+        ]
+        if len(tokens) == 0:
+            tokens = [os.getenv("GITHUB_ACCESS_TOKEN")]
+        return GitHubTokenPool(tokens)
+
+    def acquire(self, resource: str = "core") -> Optional[str]:
+        """Get the token with the most remaining requests for a resource."""
+        while True:
+            with self.__lock:
+                now = time.time()
+                best_token, best_remaining, earliest_reset = None, 0, None
+                for token in self.tokens:
+                    remaining, reset = self.__limits.get((token, resource), (None, 0))
+                    if remaining is None or reset <= now:
+                        # Unknown or already reset.
+                        remaining = float("inf")
+                    if remaining > best_remaining:
+                        best_token, best_remaining = token, remaining
+                    if remaining == 0 and (earliest_reset is None or reset < earliest_reset):
+                        earliest_reset = reset
+                if best_remaining > 0:
+                    if best_remaining != float("inf"):
+                        # Count the request in flight so concurrent callers spread out.
+                        self.__limits[(best_token, resource)] = (
+                            best_remaining - 1,
+                            self.__limits[(best_token, resource)][1],
+                        )
+                    self.requests += 1
+                    return best_token
+            if not self.wait:
+                raise RateLimitExceededException(
+                    403, {"message": "API rate limit exceeded"}, {}
+                )
+            logger.warning(
+                "all GitHub tokens are rate limited",
+                extra={"tags": {"resource": resource, "reset": earliest_reset}},
+            )
+            time.sleep(max(earliest_reset - now, 1))
+
+    def exhaust(self, token: Optional[str], reset: int, resource: str = "core") -> None:
+        """
+        Record that a token is rate limited until reset, or for a minute if
+        the reset time is unknown or past.
+        """
+        now = int(time.time())
+        with self.__lock:
+            self.__limits[(token, resource)] = (0, reset if reset > now else now + 60)
+
+    def update(self, token: Optional[str], headers, resource: str = "core") -> None:
+        """Record the rate limit of a token from response headers."""
+        headers = {k.lower(): v for k, v in headers.items()}
+        if "x-ratelimit-remaining" not in headers:
+            return
+        resource = headers.get("x-ratelimit-resource", resource)
+        with self.__lock:
+            self.__limits[(token, resource)] = (
+                int(headers["x-ratelimit-remaining"]),
+                int(headers.get("x-ratelimit-reset", 0)),
+            )
+
+
+# Hours that GitHub REST responses are kept for revalidation.
+GITHUB_CACHE_EXPIRY_HOURS = 24 * 7
+
+# Visibility of repositories by lowercase full name, see RestGitHub.is_private.
+# Entries expire since repositories can be made private.
+repo_visibility = MemoryCache(max_bytes=1024 * 1024, ttl=3600)
+
+
+class RestGitHub:
+    """
+    REST client for GitHub APIs.
+
+    Responses are kept in kv_cache with their ETag and Last-Modified headers
+    and always revalidated with a conditional request. Unchanged resources
+    come back as 304 Not Modified, which doesn't count against the rate limit.
+    Responses of private repositories are never kept. Errors are raised as
+    PyGithub exceptions.
+
+    token is either a single token or a GitHubTokenPool.
+    """
+
+    def __init__(self, token):
+        if isinstance(token, GitHubTokenPool):
+            self.tokens = token
+        else:
+            self.tokens = GitHubTokenPool([token], wait=False)
+
+    @staticmethod
+    def set_private(full_name: str, private: bool) -> None:
+        """Record the visibility of a repository known from elsewhere, e.g. GraphQL."""
+        k = full_name.lower()
+        repo_visibility.set(
+            k, private, len(k), datetime.datetime.utcnow() + datetime.timedelta(seconds=repo_visibility.ttl)
+        )
+
+    def is_private(self, full_name: str) -> bool:
+        """Check if a repository is private, fetching it if its visibility is unknown."""
+        if all(token is None for token in self.tokens.tokens):
+            # Anonymous requests only see public repositories.
+            return False
+        private = repo_visibility.get(full_name.lower())
+        if private is None:
+            private = self.get_repo(full_name)["private"]
+        return private
+
+    def get_repo(self, full_name: str) -> Dict:
+        repo = self.__get("/repos/%s" % full_name, lambda body: body["private"])
+        self.set_private(full_name, repo["private"])
+        return repo
+
+    def get_languages(self, full_name: str) -> Dict[str, int]:
+        return self.__get("/repos/%s/languages" % full_name, lambda _: self.is_private(full_name))
+
+    def get_topics(self, full_name: str) -> List[str]:
+        return self.__get("/repos/%s/topics" % full_name, lambda _: self.is_private(full_name))["names"]
+
+    def get_readme(self, full_name: str) -> Dict:
+        return self.__get("/repos/%s/readme" % full_name, lambda _: self.is_private(full_name))
+
+    def __get(self, path: str, private: Callable[[Any], bool]) -> Any:
+        """Send a GET request. private tells from the body if the response must not be kept."""
+        while True:
+            token = self.tokens.acquire("core")
+            # Responses differ per token (e.g. permissions), and so do ETags.
+            cache_key = "github:%s:%s" % (token_identity(token), path)
+            cached = get_cached(cache_key)
+            headers = {"Accept": "application/vnd.github+json"}
+            if cached is not None:
+                if cached["etag"] is not None:
+                    headers["If-None-Match"] = cached["etag"]
+                if cached["last_modified"] is not None:
+                    headers["If-Modified-Since"] = cached["last_modified"]
+            # Send request
+            if token is not None:
+                headers["Authorization"] = "token %s" % token
+            r = github_session.get(
+                "https://api.github.com" + path, headers=headers, timeout=GITHUB_TIMEOUT
+            )
+            self.tokens.update(token, r.headers, "core")
+            # Retry with another token if this one is rate limited.
+            if not is_rate_limited(r):
+                break
+        # Handle response
+        if r.status_code == 304 and cached is not None:
+            return cached["body"]
+        elif r.status_code == 200:
+            body = r.json()
+            etag, last_modified = r.headers.get("ETag"), r.headers.get("Last-Modified")
+            if (etag is not None or last_modified is not None) and not private(body):
+                save_cache(
+                    cache_key,
+                    {"etag": etag, "last_modified": last_modified, "body": body},
+                    expiry_hours=GITHUB_CACHE_EXPIRY_HOURS,
+                )
+            return body
+        try:
+            data = r.json()
+        except ValueError:
+            data = r.text
+        if r.status_code == 401:
+            raise BadCredentialsException(r.status_code, data, r.headers)
+        elif r.status_code == 404:
+            raise UnknownObjectException(r.status_code, data, r.headers)
+        else:
+            raise GithubException(r.status_code, data, r.headers)
+
+
+def token_identity(token: Optional[str]) -> str:
+    """Identify a token in cache keys without storing the token."""
+    if token is None:
+        return "anonymous"
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()[:16]
+
+
+def is_rate_limited(r: requests.Response) -> bool:
+    """Check if a GitHub response was rejected by the primary rate limit."""
+    return r.status_code in (403, 429) and r.headers.get("X-RateLimit-Remaining") == "0"
+
+
+def is_graphql_rate_limited(r: requests.Response) -> bool:
+    """
+    Check if a GitHub GraphQL response was rejected by the rate limit. Unlike
+    REST, GraphQL answers 200 with errors once the limit is hit.
+    """
+    if r.status_code != 200:
+        return is_rate_limited(r)
+    try:
+        errors = r.json().get("errors")
+    except ValueError:
+        return False
+    if not errors:
+        return False
+    return r.headers.get("X-RateLimit-Remaining") == "0" or any(
+        error.get("type") == "RATE_LIMITED" for error in errors
+    )
+
+
+def decode_readme(readme: Dict) -> str:
+    """Decode the content of a README fetched by RestGitHub.get_readme."""
+    return base64.b64decode(readme["content"]).decode("utf-8")
+
+
 class GraphQLGitHub:
     """
     GraphQL client for GitHub APIs.
     """
 
-    def __init__(self, token: str):
-        self.token = token
-
-    def __get_login(self) -> str:
-        query = "query { viewer { login } }"
-        return self.__query(query)["data"]["viewer"]["login"]
+    def __init__(self, token, page_size: int = GRAPHQL_MAX_PAGE_SIZE):
+        # A single token or a GitHubTokenPool.
+        if isinstance(token, GitHubTokenPool):
+            self.tokens = token
+        else:
+            self.tokens = GitHubTokenPool([token], wait=False)
+        self.page_size = min(page_size, GRAPHQL_MAX_PAGE_SIZE)
+        # Login of the viewer, known after the first starred page is fetched.
+        self.login = None
 
-    def __get_starred(self, pulled_at: datetime.datetime) -> List[Tuple[str, str]]:
-        stars = []
+    def __iter_starred(self, pulled_at: datetime.datetime) -> Iterator[List[Tuple[str, str]]]:
         cursor = ""
         has_next_page = True
         while has_next_page:
+            # The viewer login is fetched along with each page.
             query = (
-                'query { viewer { starredRepositories(first: 10, after: "%s", orderBy: { direction: DESC, field: STARRED_AT }) { '
+                'query { viewer { login starredRepositories(first: %d, after: "%s", orderBy: { direction: DESC, field: STARRED_AT }) { '
                 "nodes { nameWithOwner } edges { starredAt } pageInfo { endCursor hasNextPage } } } }"
-                % cursor
+                % (self.page_size, cursor)
             )
             result = self.__query(query)
+            self.login = result["data"]["viewer"]["login"]
             starred_repositories = result["data"]["viewer"]["starredRepositories"]
-            for node, edge in zip(
-                starred_repositories["nodes"], starred_repositories["edges"]
-            ):
-                stars.append((node["nameWithOwner"], edge["starredAt"]))
+            stars = [
+                (node["nameWithOwner"], edge["starredAt"])
+                for node, edge in zip(starred_repositories["nodes"], starred_repositories["edges"])
+            ]
+            if len(stars) > 0:
+                yield stars
             cursor = starred_repositories["pageInfo"]["endCursor"]
             has_next_page = starred_repositories["pageInfo"]["hasNextPage"]
             if len(stars) > 0 and pulled_at is not None:
@@ -174,15 +960,22 @@ class GraphQLGitHub:
                 utc_pulled_at = pytz.UTC.localize(pulled_at)
                 if star_at < utc_pulled_at:
                     break
-        return stars
 
     def __query(self, q):
-        # Send query
-        r = requests.post(
-            "https://api.github.com/graphql",
-            json={"query": q},
-            headers={"Authorization": "bearer %s" % self.token},
-        )
+        while True:
+            # Send query
+            token = self.tokens.acquire("graphql")
+            r = github_session.post(
+                "https://api.github.com/graphql",
+                json={"query": q},
+                headers={"Authorization": "bearer %s" % token},
+                timeout=GITHUB_TIMEOUT,
+            )
+            self.tokens.update(token, r.headers, "graphql")
+            # Retry with another token if this one is rate limited.
+            if not is_graphql_rate_limited(r):
+                break
+            self.tokens.exhaust(token, int(r.headers.get("X-RateLimit-Reset", 0)), "graphql")
         # Handle response
         if r.status_code == 200:
             return r.json()
@@ -191,19 +984,44 @@ class GraphQLGitHub:
         else:
             raise GithubException(r.status_code, r.text, r.headers)
 
-    def get_starred(self, pulled_at: datetime.datetime = None) -> List[Dict]:
-        stars = []
-        user_id = self.__get_login()
-        for item_id, timestamp in self.__get_starred(pulled_at):
-            stars.append(
+    def get_starred_summary(self) -> Tuple[int, Optional[datetime.datetime]]:
+        """
+        Get the number of starred repositories and the time of the newest star (naive UTC).
+        """
+        query = (
+            "query { viewer { login starredRepositories(first: 1, orderBy: { direction: DESC, field: STARRED_AT }) { "
+            "totalCount edges { starredAt } } } }"
+        )
+        result = self.__query(query)
+        self.login = result["data"]["viewer"]["login"]
+        starred_repositories = result["data"]["viewer"]["starredRepositories"]
+        starred_at = None
+        if len(starred_repositories["edges"]) > 0:
+            starred_at = (
+                parser.parse(starred_repositories["edges"][0]["starredAt"])
+                .astimezone(pytz.UTC)
+                .replace(tzinfo=None)
+            )
+        return starred_repositories["totalCount"], starred_at
+
+    def iter_starred(self, pulled_at: datetime.datetime = None) -> Iterator[List[Dict]]:
+        """
+        Get star feedback page by page, newest first, as pages arrive. Stops
+        after the page reaching stars older than pulled_at.
+        """
+        for starred in self.__iter_starred(pulled_at):
+            yield [
                 {
                     "FeedbackType": "star",
-                    "UserId": user_id.lower(),
+                    "UserId": self.login.lower(),
                     "ItemId": item_id.replace("/", ":").lower(),
                     "Timestamp": timestamp,
                 }
-            )
-        return stars
+                for item_id, timestamp in starred
+            ]
+
+    def get_starred(self, pulled_at: datetime.datetime = None) -> List[Dict]:
+        return [feedback for page in self.iter_starred(pulled_at) for feedback in page]
 
     def get_contributed(self) -> List[str]:
         repositories = []
@@ -211,9 +1029,9 @@ class GraphQLGitHub:
         has_next_page = True
         while has_next_page:
             query = (
-                "{ viewer { repositoriesContributedTo(first: 10, %s includeUserRepositories: true) { "
+                "{ viewer { repositoriesContributedTo(first: %d, %s includeUserRepositories: true) { "
                 "nodes { nameWithOwner } pageInfo { endCursor hasNextPage } } } }"
-                % cursor
+                % (self.page_size, cursor)
             )
             result = self.__query(query)
             contributed_repositories = result["data"]["viewer"][
@@ -225,16 +1043,347 @@ class GraphQLGitHub:
             has_next_page = contributed_repositories["pageInfo"]["hasNextPage"]
         return repositories
 
+    def get_repositories(
+        self, full_names: List[str], batch_size: int = 50
+    ) -> Dict[str, Optional[Dict]]:
+        """
+        Fetch metadata of many repositories with one aliased query per batch_size repositories.
 
-def embedding(text: str) -> list:
-    resp = openai_client.embeddings.create(
-        model="text-embedding-v3",
-        input=text,
-        dimensions=512,
+        Returns a dict from full name to metadata with the keys stargazers_count,
+        archived, private, language, description, updated_at and topics, or to None if
+        the repository doesn't exist or its name is invalid. Raises
+        GithubException if a whole query fails.
+        """
+        repositories = {}
+        valid_names = []
+        for full_name in full_names:
+            if "/" in full_name:
+                valid_names.append(full_name)
+            else:
+                logger.warning("invalid repository name", extra={"tags": {"full_name": full_name}})
+                repositories[full_name] = None
+        for i in range(0, len(valid_names), batch_size):
+            batch = valid_names[i : i + batch_size]
+            fields = []
+            for j, full_name in enumerate(batch):
+                owner, name = full_name.split("/", 1)
+                fields.append(
+                    "r%d: repository(owner: %s, name: %s) { "
+                    "stargazerCount isArchived isPrivate description updatedAt primaryLanguage { name } "
+                    "repositoryTopics(first: 100) { nodes { topic { name } } } }"
+                    % (j, json.dumps(owner), json.dumps(name))
+                )
+            # Missing repositories come back as null with NOT_FOUND errors,
+            # while a query failing as a whole has no data at all.
+            result = self.__query("query { %s }" % " ".join(fields))
+            data = result.get("data")
+            if data is None:
+                raise GithubException(200, result, None)
+            for j, full_name in enumerate(batch):
+                node = data.get("r%d" % j)
+                if node is None:
+                    repositories[full_name] = None
+                    continue
+                repositories[full_name] = {
+                    "stargazers_count": node["stargazerCount"],
+                    "archived": node["isArchived"],
+                    "private": node["isPrivate"],
+                    "language": (node["primaryLanguage"] or {}).get("name"),
+                    "description": node["description"],
+                    "updated_at": node["updatedAt"],
+                    "topics": [
+                        topic["topic"]["name"]
+                        for topic in node["repositoryTopics"]["nodes"]
+                    ],
+                }
+        return repositories
+
+
+EMBEDDING_MODEL = "text-embedding-v3"
+EMBEDDING_DIMENSIONS = 512
+
+# Limits of a single embeddings request. text-embedding-v3 accepts at most
+# 10 inputs per request, other providers accept far more.
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", 10))
+EMBEDDING_BATCH_TOKENS = int(os.getenv("EMBEDDING_BATCH_TOKENS", 8192))
+
+
+def estimate_tokens(text: str) -> int:
+    """Roughly estimate the number of tokens of a text without a tokenizer."""
+    return len(text.encode("utf-8")) // 3 + 1
+
+
+# Precision of stored embeddings: float32 or float16.
+EMBEDDING_CACHE_DTYPE = os.getenv("EMBEDDING_CACHE_DTYPE", "float32")
+
+# struct format characters of stored embedding precisions.
+VECTOR_DTYPES = {"float32": "f", "float16": "e"}
+
+
+def embedding_digest(text: str, model: str = EMBEDDING_MODEL, dimensions: int = EMBEDDING_DIMENSIONS) -> str:
+    """Get the key of a text in the embedding store."""
+    return hashlib.sha256(f"{model}\n{dimensions}\n{text}".encode("utf-8")).hexdigest()
+
+
+def pack_vector(vector: List[float], dtype: str = EMBEDDING_CACHE_DTYPE) -> bytes:
+    """Pack a vector into bytes prefixed by its struct format character."""
+    fmt = VECTOR_DTYPES[dtype]
+    return fmt.encode("ascii") + struct.pack("<%d%s" % (len(vector), fmt), *vector)
+
+
+def unpack_vector(blob: bytes) -> List[float]:
+    """Unpack a vector packed by pack_vector."""
+    fmt = chr(blob[0])
+    return list(struct.unpack("<%d%s" % ((len(blob) - 1) // struct.calcsize(fmt), fmt), blob[1:]))
+
+
+def load_embeddings(digests: List[str]) -> Dict[str, List[float]]:
+    """Load stored embeddings by digest. Missing digests are left out."""
+    embeddings = {}
+    session = get_session()
+    try:
+        for i in range(0, len(digests), 500):
+            rows = session.query(EmbeddingCache.digest, EmbeddingCache.vector).filter(
+                EmbeddingCache.digest.in_(digests[i : i + 500])
+            )
+            for digest, vector in rows:
+                embeddings[digest] = unpack_vector(vector)
+        return embeddings
+    finally:
+        session.close()
+
+
+def save_embeddings(embeddings: Dict[str, List[float]]) -> None:
+    """Store embeddings by digest. Digests stored by others meanwhile are kept."""
+    if len(embeddings) == 0:
+        return
+    now = datetime.datetime.utcnow()
+    statement = (
+        insert(EmbeddingCache)
+        .prefix_with("IGNORE", dialect="mysql")
+        .prefix_with("OR IGNORE", dialect="sqlite")
     )
-    return resp.data[0].embedding
+    with get_engine().begin() as conn:
+        conn.execute(
+            statement,
+            [
+                {
+                    "digest": digest,
+                    "model": EMBEDDING_MODEL,
+                    "dimensions": EMBEDDING_DIMENSIONS,
+                    "vector": pack_vector(vector),
+                    "created_at": now,
+                }
+                for digest, vector in embeddings.items()
+            ],
+        )
+
+
+# Decimals of embeddings shipped in item labels, or full precision if unset.
+# Full precision is kept in the embedding store either way.
+EMBEDDING_DECIMALS = int(os.getenv("EMBEDDING_DECIMALS")) if os.getenv("EMBEDDING_DECIMALS") else None
+
+
+def compact_embedding(vector: List[float], decimals: Optional[int] = EMBEDDING_DECIMALS) -> List[float]:
+    """Round an embedding to decimals to shrink item labels."""
+    if decimals is None:
+        return vector
+    return [round(value, decimals) for value in vector]
+
+
+def load_item_embeddings(items: List[Dict]) -> List[Optional[List[float]]]:
+    """
+    Load full precision embeddings of Gorse items for offline jobs. Embeddings
+    of descriptions (item comments) are loaded from the embedding store, and
+    the rest fall back to the embeddings in item labels.
+    """
+    digests = [embedding_digest(item["Comment"]) if item.get("Comment") else None for item in items]
+    stored = load_embeddings([digest for digest in digests if digest is not None])
+    embeddings = []
+    for item, digest in zip(items, digests):
+        if digest in stored:
+            embeddings.append(stored[digest])
+        elif isinstance(item.get("Labels"), dict):
+            embeddings.append(item["Labels"].get("embedding"))
+        else:
+            embeddings.append(None)
+    return embeddings
+
+
+def embedding(text: str) -> list:
+    return embedding_batch([text])[0]
+
+
+def embedding_batch(texts: List[str]) -> List[list]:
+    """
+    Embed many texts with as few requests as possible. Texts are looked up
+    in the embedding store first, and the rest are packed into requests of
+    at most EMBEDDING_BATCH_SIZE texts and EMBEDDING_BATCH_TOKENS estimated
+    tokens. Embeddings are returned in the order of texts.
+    """
+    digests = [embedding_digest(text) for text in texts]
+    stored = {}
+    use_store = os.getenv("SQLALCHEMY_DATABASE_URI") is not None
+    if use_store:
+        try:
+            stored = load_embeddings(list(set(digests)))
+        except SQLAlchemyError:
+            logger.exception("failed to load embeddings")
+            use_store = False
 
+    # Embed each missing text once.
+    missing = {}
+    for digest, text in zip(digests, texts):
+        if digest not in stored:
+            missing[digest] = text
 
+    batches, batch, batch_tokens = [], [], 0
+    for text in missing.values():
+        tokens = estimate_tokens(text)
+        if len(batch) > 0 and (
+            len(batch) >= EMBEDDING_BATCH_SIZE
+            or batch_tokens + tokens > EMBEDDING_BATCH_TOKENS
+        ):
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(text)
+        batch_tokens += tokens
+    if len(batch) > 0:
+        batches.append(batch)
+
+    embeddings = []
+    for batch in batches:
+        resp = openai_client.embeddings.create(
+            model=EMBEDDING_MODEL,
+            input=batch,
+            dimensions=EMBEDDING_DIMENSIONS,
+        )
+        embeddings.extend(data.embedding for data in sorted(resp.data, key=lambda data: data.index))
+
+    computed = dict(zip(missing.keys(), embeddings))
+    if use_store:
+        try:
+            save_embeddings(computed)
+        except SQLAlchemyError:
+            logger.exception("failed to save embeddings")
+    stored.update(computed)
+    return [stored[digest] for digest in digests]
+
+
+# Estimated tokens of README kept for summarization.
+README_TOKEN_BUDGET = int(os.getenv("README_TOKEN_BUDGET", 1024))
+
+# Sections of README that say little about what a repository is.
+README_SKIPPED_SECTIONS = re.compile(
+    r"change ?log|release notes|license|contribut|acknowledg|sponsor|backer|star history|citation",
+    re.IGNORECASE,
+)
+
+README_NOISE_PATTERNS = [
+    # HTML comments
+    (re.compile(r"<!--.*?-->", re.DOTALL), ""),
+    # Fenced code blocks
+    (re.compile(r"^\s*(```|~~~).*?^\s*\1[^\n]*$", re.DOTALL | re.MULTILINE), ""),
+    # Images and badges, including linked ones
+    (re.compile(r"!\[[^\]]*\]\([^)]*\)|!\[[^\]]*\]\[[^\]]*\]"), ""),
+    # HTML tags
+    (re.compile(r"<[^>]+>"), ""),
+    # Link reference definitions
+    (re.compile(r"^\s*\[[^\]]+\]:\s*\S+.*$", re.MULTILINE), ""),
+    # Links are replaced by their text
+    (re.compile(r"\[([^\]]*)\]\([^)]*\)|\[([^\]]*)\]\[[^\]]*\]"), lambda m: m.group(1) or m.group(2) or ""),
+    # Bare URLs
+    (re.compile(r"https?://\S+"), ""),
+    # Table rows and separators
+    (re.compile(r"^\s*\|.*$|^\s*[:\-| ]+\|[:\-| ]*$", re.MULTILINE), ""),
+    # Horizontal rules
+    (re.compile(r"^\s*([-*_=])\1{2,}\s*$", re.MULTILINE), ""),
+]
+
+README_HEADING = re.compile(r"^#{1,6}\s+\S")
+
+
+def preprocess_readme(text: str, max_tokens: int = README_TOKEN_BUDGET) -> str:
+    """
+    Reduce README to prose for summarization. Markup, badges, code blocks,
+    tables and links are stripped. The title and the first sections are kept
+    in order, then only the headings of the remaining sections, within
+    max_tokens estimated tokens.
+    """
+    for pattern, repl in README_NOISE_PATTERNS:
+        text = pattern.sub(repl, text)
+
+    # Split into sections by heading.
+    sections = [[]]
+    for line in text.splitlines():
+        line = line.rstrip()
+        if README_HEADING.match(line):
+            sections.append([line])
+        elif line or (sections[-1] and sections[-1][-1]):
+            sections[-1].append(line)
+    sections = [
+        section
+        for section in sections
+        if any(section) and not (README_HEADING.match(section[0]) and README_SKIPPED_SECTIONS.search(section[0]))
+    ]
+
+    kept, tokens, full = [], 0, True
+    for section in sections:
+        body = "\n".join(section).strip()
+        if full and tokens + estimate_tokens(body) <= max_tokens:
+            kept.append(body)
+            tokens += estimate_tokens(body)
+            continue
+        if full and len(kept) == 0:
+            # The first section alone is over budget.
+            kept.append(body.encode("utf-8")[: max_tokens * 3].decode("utf-8", "ignore"))
+            break
+        full = False
+        heading = section[0] if README_HEADING.match(section[0]) else None
+        if heading is not None and tokens + estimate_tokens(heading) <= max_tokens:
+            kept.append(heading)
+            tokens += estimate_tokens(heading)
+    return "\n\n".join(kept)
+
+
+# LLM answers only change with the model, so they are kept for a long time.
+LLM_CACHE_EXPIRY_HOURS = 24 * 365
+
+
+def memoize_llm(kind: str):
+    """
+    Memoize an LLM call on text in kv_cache by kind, model and a hash of the
+    text, so that re-runs over the same repositories are free. The result must
+    be JSON serializable. Memoization is skipped if no database is configured.
+    """
+
+    def decorator(fn: Callable[[str], Any]) -> Callable[[str], Any]:
+        @functools.wraps(fn)
+        def wrapper(text: str) -> Any:
+            if os.getenv("SQLALCHEMY_DATABASE_URI") is None:
+                return fn(text)
+            digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+            key = f"llm:{kind}:{OPENAI_MODEL}:{digest}"
+            try:
+                result = get_cached(key)
+            except SQLAlchemyError:
+                logger.exception("failed to load llm result", extra={"tags": {"key": key}})
+                return fn(text)
+            if result is not None:
+                return result
+            result = fn(text)
+            try:
+                save_cache(key, result, expiry_hours=LLM_CACHE_EXPIRY_HOURS)
+            except SQLAlchemyError:
+                logger.exception("failed to save llm result", extra={"tags": {"key": key}})
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+@memoize_llm("tldr")
 def tldr(text: str) -> str:
     prompt = (
         "Write a short description of the GitHub repository in one sentence. "
@@ -259,6 +1408,7 @@ class AIRelevance(BaseModel):
     is_ai_related: bool
 
 
+@memoize_llm("isai")
 def isai(text: str) -> bool:
     """
     Determine if a repository is related to AI based on its description.
@@ -297,93 +1447,517 @@ def isai(text: str) -> bool:
     return resp.choices[0].message.parsed.is_ai_related
 
 
-def get_repo_info(github_client: Github, full_name: str) -> Optional[Dict]:
+class RepoSummary(BaseModel):
+    """Model for repository summary with AI relevance detection."""
+
+    summary: str
+    is_ai_related: bool
+
+
+@memoize_llm("summarize")
+def summarize(text: str) -> Dict:
     """
-    Get GitHub repository information.
+    Summarize a repository and determine if it is related to AI in one call.
+
+    Args:
+        text: The README content of the repository.
+
+    Returns:
+        A dict with the one-sentence "summary" and "is_ai_related".
+    """
+    prompt = (
+        "Write a short description of the GitHub repository in one sentence. "
+        + "Don't start with 'This GitHub repository' or 'A GitHub repository'. "
+        + "Also determine if the repository is related to Artificial Intelligence (AI), "
+        "Large Language Models (LLMs), Vision Language Model (VLM), World Model, "
+        "Retrieval-Augmented Generation (RAG), Vector Database, Embedding, Agent,"
+        "Vibe Coding, Harness Engineering, or other AI fields. "
+        "Consider libraries, frameworks, models, and tools for AI development.\n\n"
+        f"The README of the repository is: \n\n{text}"
+    )
+
+    resp = openai_client.beta.chat.completions.parse(
+        model=OPENAI_MODEL,
+        messages=[
+            {
+                "role": "user",
+                "content": prompt,
+            }
+        ],
+        response_format=RepoSummary,
+        extra_body={
+            "chat_template_kwargs": {
+                "enable_thinking": False,
+            }
+        },
+    )
+
+    parsed = resp.choices[0].message.parsed
+    return {"summary": parsed.summary, "is_ai_related": parsed.is_ai_related}
+
+
+def describe_repo(
+    full_name: str, metadata: Dict, get_readme: Callable[[], str]
+) -> Optional[Tuple[str, Dict]]:
+    """
+    Create a Gorse item without embedding from repository metadata (see
+    GraphQLGitHub.get_repositories). Returns the description to embed and
+    the item. get_readme is only called if the repository has no description.
     """
-    repo = github_client.get_repo(full_name)
     # Ignore repo with less than 100 stars or archived
-    if repo.stargazers_count < 100 or repo.archived:
+    if metadata["stargazers_count"] < 100 or metadata["archived"]:
         return None
-    # Fetch languages.
     categories = None
-    languages = repo.get_languages()
-    if len(languages) > 0:
-        categories = [max(languages, key=languages.get).lower()]
+    if metadata["language"] is not None:
+        categories = [metadata["language"].lower()]
     # Encode embedding.
-    description = repo.description
+    description = metadata["description"]
     if description is None:
-        description = tldr(repo.get_readme().decoded_content.decode("utf-8"))
+        summary = summarize(preprocess_readme(get_readme()))
+        description = summary["summary"]
+        ai_related = summary["is_ai_related"]
         print("QWEN:", description)
+    else:
+        ai_related = isai(description)
 
     # Check if repository is AI-related and add "ai" category
-    if isai(description):
+    if ai_related:
         if categories is None:
             categories = ["ai"]
         elif "ai" not in categories:
             categories.append("ai")
 
-    description_embedding = embedding(description)
     item = {
         "ItemId": full_name.replace("/", ":").lower(),
-        "Timestamp": str(repo.updated_at),
+        "Timestamp": metadata["updated_at"],
         "Labels": {
-            "embedding": description_embedding,
-            "topics": repo.get_topics(),
+            "embedding": None,
+            "topics": metadata["topics"],
         },
         "Categories": categories,
-        "Comment": repo.description,
+        "Comment": metadata["description"],
     }
+    return description, item
+
+
+def make_repo_item(
+    full_name: str, metadata: Dict, get_readme: Callable[[], str]
+) -> Optional[Dict]:
+    """
+    Create a Gorse item from repository metadata (see GraphQLGitHub.get_repositories).
+    get_readme is only called if the repository has no description.
+    """
+    described = describe_repo(full_name, metadata, get_readme)
+    if described is None:
+        return None
+    description, item = described
+    item["Labels"]["embedding"] = compact_embedding(embedding(description))
     return item
 
 
-def update_user(
-    gorse_client: Gorse,
-    token: str,
-    pulled_at: datetime.datetime,
-):
+def get_repo_info(github_client: RestGitHub, full_name: str) -> Optional[Dict]:
     """
-    Update GitHub user labels and starred repositories.
+    Get GitHub repository information.
+    """
+    repo = github_client.get_repo(full_name)
+    # Ignore repo with less than 100 stars or archived
+    if repo["stargazers_count"] < 100 or repo["archived"]:
+        return None
+    # Fetch languages.
+    language = None
+    languages = github_client.get_languages(full_name)
+    if len(languages) > 0:
+        language = max(languages, key=languages.get)
+    metadata = {
+        "stargazers_count": repo["stargazers_count"],
+        "archived": repo["archived"],
+        "language": language,
+        "description": repo["description"],
+        "updated_at": repo["updated_at"],
+        "topics": github_client.get_topics(full_name),
+    }
+    return make_repo_item(
+        full_name,
+        metadata,
+        lambda: decode_readme(github_client.get_readme(full_name)),
+    )
+
+
+# Concurrency limits of enrichment stages.
+ENRICHMENT_GITHUB_WORKERS = int(os.getenv("ENRICHMENT_GITHUB_WORKERS", 8))
+ENRICHMENT_LLM_WORKERS = int(os.getenv("ENRICHMENT_LLM_WORKERS", 8))
+ENRICHMENT_EMBEDDING_WORKERS = int(os.getenv("ENRICHMENT_EMBEDDING_WORKERS", 4))
+
+# Repositories per GraphQL metadata request of enrichment.
+ENRICHMENT_METADATA_BATCH_SIZE = 50
+
+
+class EnrichmentPipeline:
+    """
+    Enrich repositories into Gorse items with many repositories in flight.
+
+    Metadata is fetched in bulk by GraphQL and READMEs by REST on the GitHub
+    pool, descriptions are summarized and classified on the LLM pool, and
+    descriptions are embedded in batches on the embedding pool. Each pool has
+    its own concurrency limit. Repositories that fail or are ignored are
+    skipped.
     """
-    # Pull user starred repos
-    github_client = Github(token)
-    graphql_client = GraphQLGitHub(token)
-    stars = graphql_client.get_starred(pulled_at)
-    # Pull items
-    item_count, pull_count = 0, 0
-    for feedback in stars:
-        item_id = feedback["ItemId"]
 
+    def __init__(
+        self,
+        github_client: RestGitHub,
+        graphql_client: GraphQLGitHub,
+        github_workers: int = ENRICHMENT_GITHUB_WORKERS,
+        llm_workers: int = ENRICHMENT_LLM_WORKERS,
+        embedding_workers: int = ENRICHMENT_EMBEDDING_WORKERS,
+    ):
+        self.github_client = github_client
+        self.graphql_client = graphql_client
+        self.github_workers = github_workers
+        self.llm_workers = llm_workers
+        self.embedding_workers = embedding_workers
+
+    def run(self, full_names: List[str]) -> Iterator[Dict]:
+        """Enrich repositories and yield Gorse items as soon as they are ready."""
+        with ThreadPoolExecutor(self.github_workers) as github_executor, ThreadPoolExecutor(
+            self.llm_workers
+        ) as llm_executor, ThreadPoolExecutor(self.embedding_workers) as embedding_executor:
+
+            def readme_getter(full_name: str) -> Callable[[], str]:
+                # README requests count against the GitHub limit, not the LLM one.
+                return lambda: github_executor.submit(
+                    lambda: decode_readme(self.github_client.get_readme(full_name))
+                ).result()
+
+            # Futures in flight mapped to their stage, repositories and described repositories.
+            pending = {}
+            for i in range(0, len(full_names), ENRICHMENT_METADATA_BATCH_SIZE):
+                batch = full_names[i : i + ENRICHMENT_METADATA_BATCH_SIZE]
+                future = github_executor.submit(self.graphql_client.get_repositories, batch)
+                pending[future] = ("metadata", batch, None)
+            # Described repositories waiting to be embedded.
+            described = []
+
+            while len(pending) > 0:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, repos, batch = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception:
+                        logger.exception(
+                            "failed to enrich repos",
+                            extra={"tags": {"stage": stage, "repos": repos}},
+                        )
+                        continue
+                    if stage == "metadata":
+                        for full_name, metadata in result.items():
+                            if metadata is None:
+                                continue
+                            # Spares a request for the visibility of the README.
+                            self.github_client.set_private(full_name, metadata["private"])
+                            future = llm_executor.submit(
+                                describe_repo, full_name, metadata, readme_getter(full_name)
+                            )
+                            pending[future] = ("describe", [full_name], None)
+                    elif stage == "describe":
+                        if result is not None:
+                            described.append(result)
+                    else:
+                        for (_, item), description_embedding in zip(batch, result):
+                            item["Labels"]["embedding"] = compact_embedding(description_embedding)
+                            yield item
+
+                # Embed full batches, and the rest once nothing else is being described.
+                describing = any(stage != "embed" for stage, _, _ in pending.values())
+                while len(described) >= EMBEDDING_BATCH_SIZE or (len(described) > 0 and not describing):
+                    batch, described = described[:EMBEDDING_BATCH_SIZE], described[EMBEDDING_BATCH_SIZE:]
+                    future = embedding_executor.submit(
+                        embedding_batch, [description for description, _ in batch]
+                    )
+                    pending[future] = ("embed", [item["ItemId"] for _, item in batch], batch)
+
+
+def get_repos_info(
+    github_client: RestGitHub, graphql_client: GraphQLGitHub, full_names: List[str]
+) -> List[Dict]:
+    """
+    Get GitHub repository information of many repositories. See EnrichmentPipeline.
+    """
+    return list(EnrichmentPipeline(github_client, graphql_client).run(full_names))
+
+
+def insert_items(gorse_client: Gorse, items: List[Dict]) -> Dict:
+    """
+    Insert items into Gorse in one request. PyGorse only inserts one item
+    per request, so this posts to the batch endpoint the same way it does.
+    """
+    r = requests.post(
+        f"{gorse_client.entry_point}/api/items",
+        json=items,
+        headers={"X-API-Key": gorse_client.api_key},
+        timeout=gorse_client.timeout,
+    )
+    if r.status_code == 200:
+        return r.json()
+    raise GorseException(r.status_code, r.text)
+
+
+# Seconds a task is not enqueued again after it was enqueued with the same key.
+TASK_DEDUP_SECONDS = int(os.getenv("TASK_DEDUP_SECONDS", 3600))
+
+
+def enqueue_once(task, key: str, *args, window: int = TASK_DEDUP_SECONDS) -> bool:
+    """
+    Enqueue a Celery task unless a task with the same key was enqueued
+    within window seconds by any worker. Keys look like "pull:<login>" and
+    are case-insensitive, like GitHub logins and repository names. Returns
+    whether the task was enqueued.
+    """
+    k = f"task:{key.lower()}"
+    owner = None
+    try:
+        owner = acquire_lease(k, window)
+        if owner is None:
+            return False
+    except SQLAlchemyError:
+        # Prefer a duplicate task to a lost one.
+        logger.exception("failed to deduplicate task", extra={"tags": {"key": key}})
+    try:
+        task.delay(*args)
+    except Exception:
+        # Let the next request enqueue the task instead of suppressing it.
+        if owner is not None:
+            try:
+                release_lease(k, owner)
+            except SQLAlchemyError:
+                logger.exception("failed to release task lease", extra={"tags": {"key": key}})
+        raise
+    return True
+
+
+def mark_enriched(item_id: str, hours: float) -> None:
+    """Record that an item was enriched, for hours. See recently_enriched."""
+    save_cache(f"enriched:{item_id}", True, expiry_hours=hours)
+
+
+def recently_enriched(item_ids: List[str]) -> set:
+    """Get item IDs among item_ids marked by mark_enriched that are still fresh."""
+    keys = {f"enriched:{item_id}": item_id for item_id in item_ids}
+    now = datetime.datetime.utcnow()
+    enriched = set()
+    session = get_session()
+    try:
+        key_list = list(keys)
+        for i in range(0, len(key_list), 500):
+            rows = session.query(KvCache.k).filter(
+                KvCache.k.in_(key_list[i : i + 500]), KvCache.expire > now
+            )
+            enriched.update(keys[k] for k, in rows)
+        return enriched
+    finally:
+        session.close()
+
+
+# Path of the persisted known item set.
+KNOWN_ITEMS_PATH = os.getenv("KNOWN_ITEMS_PATH", "/var/lib/gitrec/known_items.txt.gz")
+# Seconds before the known item set is rebuilt from Gorse.
+KNOWN_ITEMS_MAX_AGE = int(os.getenv("KNOWN_ITEMS_MAX_AGE", 6 * 3600))
+# Minimum seconds between saves of the known item set after changes.
+KNOWN_ITEMS_SAVE_INTERVAL = 60
+
+
+class KnownItems:
+    """
+    Local set of item IDs in Gorse, so that existence checks need no round
+    trips. The set is built from a get_items scan, kept up to date by add and
+    discard, and persisted to disk for fast startup. Once older than max_age
+    it is rebuilt in the background while the old set keeps serving, to pick
+    up changes by other processes. Items deleted elsewhere, such as by
+    app.delete_repo or app.fetch_repo, are only dropped by these rebuilds.
+    """
+
+    def __init__(self, gorse_client: Gorse, path: str = KNOWN_ITEMS_PATH, max_age: int = KNOWN_ITEMS_MAX_AGE):
+        self.gorse_client = gorse_client
+        self.path = path
+        self.max_age = max_age
+        self.__lock = threading.Lock()
+        # Held while building the first set, when there is nothing to serve.
+        self.__build_lock = threading.Lock()
+        self.__items = None
+        self.__refreshed_at = 0.0
+        self.__saved_at = 0.0
+        self.__dirty = False
+        # Changes made during a rebuild, replayed on the rebuilt set.
+        self.__changes = None
+
+    def __load(self):
+        """Load the set from disk, or build it if missing. Start a rebuild if expired."""
+        if self.__items is None:
+            with self.__build_lock:
+                with self.__lock:
+                    if self.__items is None and os.path.exists(self.path):
+                        try:
+                            with gzip.open(self.path, "rt", encoding="utf-8") as f:
+                                refreshed_at = float(f.readline())
+                                self.__items = set(line.rstrip("\n") for line in f)
+                            self.__refreshed_at = refreshed_at
+                        except (OSError, ValueError):
+                            logger.exception("failed to load known items", extra={"tags": {"path": self.path}})
+                    build = self.__items is None
+                    if build:
+                        self.__changes = []
+                if build:
+                    self.__refresh()
+                    return
+        with self.__lock:
+            if self.__changes is not None or time.time() - self.__refreshed_at <= self.max_age:
+                return
+            self.__changes = []
+        threading.Thread(target=self.__refresh, daemon=True).start()
+
+    def __refresh(self):
+        """Rebuild the set from a get_items scan without blocking readers."""
+        start = time.time()
         try:
-            # Skip indexed repositories.
-            item = gorse_client.get_item(item_id)
-            continue
-        except GorseException:
-            pass
+            items, cursor = set(), ""
+            while True:
+                page, cursor = self.gorse_client.get_items(1000, cursor)
+                items.update(item["ItemId"] for item in page)
+                if cursor == "":
+                    break
+        except Exception:
+            logger.exception("failed to refresh known items")
+            with self.__lock:
+                self.__changes = None
+            if self.__items is None:
+                raise
+            return
+        with self.__lock:
+            for add, item_ids in self.__changes:
+                if add:
+                    items.update(item_ids)
+                else:
+                    items.difference_update(item_ids)
+            self.__items = items
+            self.__refreshed_at = start
+            self.__changes = None
+            self.__save()
+        logger.info(
+            "refresh known items",
+            extra={"tags": {"num_items": len(items), "seconds": round(time.time() - start, 1)}},
+        )
 
-        full_name = item_id.replace(":", "/")
+    def __save(self):
+        """Write the set to disk atomically. The lock must be held."""
+        # Processes sharing the file write to their own temporary files.
+        tmp_path = "%s.%d.tmp" % (self.path, os.getpid())
         try:
-            item = get_repo_info(github_client, full_name)
-            if item is not None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+                f.write(f"{self.__refreshed_at}\n")
+                for item_id in sorted(self.__items):
+                    f.write(item_id + "\n")
+            os.replace(tmp_path, self.path)
+        except OSError:
+            logger.exception("failed to save known items", extra={"tags": {"path": self.path}})
+        self.__saved_at = time.time()
+        self.__dirty = False
+
+    def __change(self, add: bool, item_ids: List[str]):
+        """Apply a change and save at most every KNOWN_ITEMS_SAVE_INTERVAL seconds. The lock must be held."""
+        if add:
+            self.__items.update(item_ids)
+        else:
+            self.__items.difference_update(item_ids)
+        if self.__changes is not None:
+            self.__changes.append((add, list(item_ids)))
+        self.__dirty = True
+        if time.time() - self.__saved_at > KNOWN_ITEMS_SAVE_INTERVAL:
+            self.__save()
+
+    def filter_unknown(self, item_ids: List[str]) -> List[str]:
+        """Get item IDs not in Gorse, in the given order."""
+        self.__load()
+        with self.__lock:
+            return [item_id for item_id in item_ids if item_id not in self.__items]
+
+    def add(self, item_ids: List[str]):
+        """Record items inserted into Gorse."""
+        self.__load()
+        with self.__lock:
+            self.__change(True, item_ids)
+
+    def discard(self, item_ids: List[str]):
+        """Record items deleted from Gorse."""
+        self.__load()
+        with self.__lock:
+            self.__change(False, item_ids)
+
+    def save(self):
+        """Write unsaved changes to disk."""
+        with self.__lock:
+            if self.__dirty and self.__items is not None:
+                self.__save()
+
+
+def update_user(gorse_client: Gorse, user: User, known_items: KnownItems):
+    """
+    Update GitHub user labels and starred repositories. Stars are streamed
+    page by page: repositories of each page are enriched and inserted, and
+    then its feedback (at most GRAPHQL_MAX_PAGE_SIZE) is inserted at once,
+    so recommendations improve while a large account is still syncing. The
+    caller commits the starred summary saved on the user. Returns the number
+    of GitHub API requests sent.
+    """
+    tokens = GitHubTokenPool([user.token["access_token"]], wait=False)
+    github_client = RestGitHub(tokens)
+    graphql_client = GraphQLGitHub(tokens)
+    # Skip users who starred nothing since the last pull.
+    starred_count, starred_at = graphql_client.get_starred_summary()
+    if (
+        user.pulled_at is not None
+        and starred_count == user.starred_count
+        and starred_at == user.starred_at
+    ):
+        logger.info(
+            "skip user without new stars",
+            extra={"tags": {"user_id": graphql_client.login}},
+        )
+        return tokens.requests
+    pipeline = EnrichmentPipeline(github_client, graphql_client)
+    item_count, feedback_count = 0, 0
+    # Pull user starred repos
+    for stars in graphql_client.iter_starred(user.pulled_at):
+        # Pull items not indexed yet
+        full_names = [
+            item_id.replace(":", "/")
+            for item_id in known_items.filter_unknown([feedback["ItemId"] for feedback in stars])
+        ]
+        for item in pipeline.run(full_names):
+            try:
                 gorse_client.insert_item(item)
+                known_items.add([item["ItemId"]])
                 item_count += 1
-        except Exception as e:
-            logger.exception("failed to get repo info")
-        pull_count += 1
-    logger.info(
-        "insert user starred repositories",
-        extra={
-            "tags": {"user_id": github_client.get_user().login, "num_items": item_count}
-        },
-    )
-    # Insert feedback
-    gorse_client.insert_feedbacks(stars)
-    logger.info(
-        "insert feedback from user",
-        extra={
-            "tags": {
-                "user_id": github_client.get_user().login,
-                "num_feedback": len(stars),
-            }
-        },
-    )
+            except Exception:
+                logger.exception("failed to insert repo")
+        # Insert feedback of the page once its repositories are inserted
+        if len(stars) > 0:
+            gorse_client.insert_feedbacks(stars)
+            feedback_count += len(stars)
+            logger.info(
+                "insert feedback from user",
+                extra={
+                    "tags": {
+                        "user_id": graphql_client.login,
+                        "num_items": item_count,
+                        "num_feedback": feedback_count,
+                    }
+                },
+            )
+    known_items.save()
+    user.starred_count = starred_count
+    user.starred_at = starred_at
+    return tokens.requests
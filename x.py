@@ -6,9 +6,9 @@ from typing import Optional
 import click
 import MySQLdb
 from pickledb import PickleDB
+from github import Github
 from github.GithubException import GithubException, RateLimitExceededException, UnknownObjectException
 from google.protobuf import message, timestamp_pb2
-from gorse import GorseException
 from dotenv import load_dotenv
 from openai import BadRequestError, InternalServerError, OpenAI
 from tqdm import tqdm
@@ -22,9 +22,13 @@ from utils import *
 
 # Create Gorse client
 gorse_client = Gorse("http://127.0.0.1:8088", os.getenv("GORSE_API_KEY"))
+known_items = KnownItems(gorse_client)
 
-# Create GitHub client.
-github_client = Github(os.getenv("GITHUB_ACCESS_TOKEN"))
+# Create GitHub clients. Bulk work is spread over all service tokens.
+token_pool = GitHubTokenPool.from_env()
+github_client = Github(token_pool.tokens[0])
+rest_client = RestGitHub(token_pool)
+graphql_client = GraphQLGitHub(token_pool)
 
 # Create GraphQL client.
 openai_client = OpenAI(
@@ -41,9 +45,11 @@ def command():
 @click.argument("full_name")
 def upsert_repo(full_name):
     """Upsert a repository into GitRec."""
-    repo = get_repo_info(github_client, full_name)
+    repo = get_repo_info(rest_client, full_name)
     if repo is not None:
         gorse_client.insert_item(repo)
+        known_items.add([repo["ItemId"]])
+        known_items.save()
         print('UPSERT', full_name)
     else:
         print('IGNORE', full_name)
@@ -60,6 +66,8 @@ def get_repo(full_name):
 @click.argument("full_name")
 def delete_repo(full_name):
     gorse_client.delete_item(full_name.replace('/', ':').lower())
+    known_items.discard([full_name.replace('/', ':').lower()])
+    known_items.save()
     print('DELETE', full_name)
 
 
@@ -70,30 +78,28 @@ def search_and_upsert(topic: Optional[str] = None, language: Optional[str] = Non
     if language is not None:
         query += " language:" + language
     print("SEARCH " + query)
-    repos = github_client.search_repositories(query)
-    for repo in repos:
-        # Skip existed repo.
-        try:
-            gorse_client.get_item(repo.full_name.replace("/", ":").lower())
-            continue
-        except GorseException as e:
-            if e.status_code != 404:
-                print(e)
-                continue
-        except RateLimitExceededException as e:
-            print(e)
-            time.sleep(1800)
-            continue
-        except Exception as e:
-            print(e)
-            continue
-        # Insert repo
-        item = get_repo_info(github_client, repo.full_name)
-        if item is not None:
-            gorse_client.insert_item(item)
-            print("INSERT " + repo.full_name)
-        else:
-            print("IGNORE " + repo.full_name)
+    token = token_pool.acquire("search")
+    full_names = []
+    try:
+        repos = Github(token).search_repositories(query)
+        for repo in repos:
+            full_names.append(repo.full_name)
+    except RateLimitExceededException as e:
+        # The next search goes to another token or waits for the earliest reset.
+        token_pool.update(token, e.headers, "search")
+        raise
+    # Skip existed repos.
+    unknown = set(known_items.filter_unknown([full_name.replace("/", ":").lower() for full_name in full_names]))
+    full_names = [full_name for full_name in full_names if full_name.replace("/", ":").lower() in unknown]
+    # Insert repos
+    inserted = 0
+    for item in EnrichmentPipeline(rest_client, graphql_client).run(full_names):
+        gorse_client.insert_item(item)
+        known_items.add([item["ItemId"]])
+        inserted += 1
+        print("INSERT " + item["ItemId"])
+    known_items.save()
+    print(f"IGNORE {len(full_names) - inserted} repos")
 
 
 @command.command()
@@ -122,19 +128,39 @@ def insert_repos():
                     break
                 except RateLimitExceededException as e:
                     print(e)
-                    time.sleep(1800)
                     continue
                 except Exception as e:
                     print(e)
                     break
 
 
+def embedding_or_skip(texts: List[str]) -> List[Optional[list]]:
+    """
+    Embed texts in batches. If a batch is rejected, embed its texts one by
+    one and return None for those that fail.
+    """
+    try:
+        return embedding_batch(texts)
+    except (BadRequestError, InternalServerError, ConnectionError) as e:
+        print("FAIL batch embedding " + str(e))
+    embeddings = []
+    for text in texts:
+        try:
+            embeddings.append(embedding(text))
+        except (BadRequestError, InternalServerError, ConnectionError) as e:
+            print("FAIL embedding " + str(e))
+            embeddings.append(None)
+    return embeddings
+
+
 @command.command()
 def upgrade_items():
     """Upgrade items in Gorse."""
     cursor = ""
     while True:
         items, cursor = gorse_client.get_items(1000, cursor)
+        # Items to update once their descriptions are embedded in batches.
+        pending = []
         for item in items:
             if type(item["Labels"]) == list:
                 # Fetch repo
@@ -182,11 +208,10 @@ def upgrade_items():
                         language = [max(languages, key=languages.get).lower()]
                     description = repo.description
                     if description is None:
-                        description = tldr(
-                            repo.get_readme().decoded_content.decode("utf-8")
-                        )
+                        description = summarize(
+                            preprocess_readme(repo.get_readme().decoded_content.decode("utf-8"))
+                        )["summary"]
                         print("QWEN:", description)
-                    description_embedding = embedding(description)
                 except BadRequestError as e:
                     print("FAIL " + repo.full_name + " " + str(e))
                     continue
@@ -204,18 +229,25 @@ def upgrade_items():
                     print("FAIL " + repo.full_name + " " + str(e))
                     continue
 
-                # Update item
-                gorse_client.update_item(
-                    item["ItemId"],
-                    categories=language,
-                    labels={
-                        "embedding": description_embedding,
-                        "topics": repo.get_topics(),
-                    },
-                    timestamp=repo.updated_at.strftime("%Y-%m-%dT%H:%M:%SZ"),
-                    comment=repo.description,
-                )
-                print("UPGRADE " + repo.full_name)
+                pending.append((item["ItemId"], repo, language, description))
+
+        embeddings = embedding_or_skip([description for _, _, _, description in pending])
+        for (item_id, repo, language, _), description_embedding in zip(pending, embeddings):
+            if description_embedding is None:
+                print("FAIL " + repo.full_name)
+                continue
+            # Update item
+            gorse_client.update_item(
+                item_id,
+                categories=language,
+                labels={
+                    "embedding": compact_embedding(description_embedding),
+                    "topics": repo.get_topics(),
+                },
+                timestamp=repo.updated_at.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                comment=repo.description,
+            )
+            print("UPGRADE " + repo.full_name)
         if cursor == "":
             break
 
@@ -226,18 +258,154 @@ def upgrade_embedding():
     cursor = ""
     while True:
         items, cursor = gorse_client.get_items(1000, cursor)
-        for item in tqdm(items):
-            if len(item["Comment"]) > 0:
-                item["Labels"]["embedding"] = embedding(item["Comment"])
+        items = [item for item in items if len(item["Comment"]) > 0]
+        embeddings = embedding_or_skip([item["Comment"] for item in items])
+        for item, description_embedding in tqdm(zip(items, embeddings), total=len(items)):
+            if description_embedding is not None:
+                item["Labels"]["embedding"] = compact_embedding(description_embedding)
                 gorse_client.update_item(
                     item["ItemId"],
                     labels=item["Labels"],
                 )
-        
+
         if cursor == "":
             break
 
 
+@command.command()
+@click.option("--prefix", default="repo:", help="Benchmark cache entries with this key prefix.")
+@click.option("--limit", default=200, help="Number of cache entries to sample.")
+def benchmark_cache_codec(prefix: str, limit: int):
+    """Benchmark kv_cache codecs on cached payloads such as rendered READMEs."""
+    session = get_session()
+    try:
+        rows = session.query(KvCache).filter(KvCache.k.like(prefix + "%")).limit(limit).all()
+        payloads = [decode_cache_value(row.v) for row in rows]
+    finally:
+        session.close()
+    if len(payloads) == 0:
+        print("No cache entries found with prefix " + prefix)
+        return
+
+    raw_size = sum(len(data) for data in payloads)
+    print(f"{len(payloads)} payloads, {raw_size / len(payloads) / 1024:.1f} KiB on average")
+    print(f"{'codec':<8}{'size':>12}{'ratio':>8}{'encode':>12}{'decode':>12}")
+    for codec in CACHE_CODECS:
+        start = time.perf_counter()
+        blobs = [encode_cache_value(data, codec) for data in payloads]
+        encode_time = time.perf_counter() - start
+        start = time.perf_counter()
+        for blob in blobs:
+            json.loads(decode_cache_value(blob))
+        decode_time = time.perf_counter() - start
+        size = sum(len(blob) for blob in blobs)
+        print(
+            f"{codec:<8}{size / 1024:>9.1f}KiB{raw_size / size:>8.2f}"
+            f"{encode_time / len(blobs) * 1000:>10.2f}ms{decode_time / len(blobs) * 1000:>10.2f}ms"
+        )
+
+
+@command.command()
+@click.option("--limit", default=20, help="Number of READMEs to sample from Gorse items.")
+@click.option("--max-tokens", default=README_TOKEN_BUDGET, help="Token budget of processed READMEs.")
+def benchmark_readme(limit: int, max_tokens: int):
+    """Benchmark tldr on raw and preprocessed READMEs."""
+    readmes = []
+    cursor = ""
+    while len(readmes) < limit:
+        items, cursor = gorse_client.get_items(100, cursor)
+        for item in items:
+            if len(readmes) >= limit:
+                break
+            try:
+                readmes.append(decode_readme(rest_client.get_readme(item["ItemId"].replace(":", "/"))))
+            except GithubException as e:
+                print("FAIL " + item["ItemId"] + " " + str(e))
+        if cursor == "":
+            break
+    if len(readmes) == 0:
+        print("No READMEs found")
+        return
+
+    print(f"{len(readmes)} READMEs")
+    print(f"{'input':<12}{'tokens':>10}{'latency':>12}{'failures':>10}")
+    for name, texts in (
+        ("raw", readmes),
+        ("processed", [preprocess_readme(readme, max_tokens) for readme in readmes]),
+    ):
+        tokens = sum(estimate_tokens(text) for text in texts)
+        latency, failures = 0.0, 0
+        for text in tqdm(texts):
+            start = time.perf_counter()
+            try:
+                # Bypass the memo to measure the model.
+                tldr.__wrapped__(text)
+            except (BadRequestError, InternalServerError):
+                failures += 1
+            latency += time.perf_counter() - start
+        print(f"{name:<12}{tokens // len(texts):>10}{latency / len(texts):>11.2f}s{failures:>10}")
+
+
+def nearest_neighbors(vectors: List[List[float]], k: int) -> List[set]:
+    """Find k nearest neighbors of each vector by Euclidean distance."""
+    neighbors = []
+    for i, u in enumerate(vectors):
+        distances = [
+            (sum((a - b) ** 2 for a, b in zip(u, v)), j) for j, v in enumerate(vectors) if j != i
+        ]
+        neighbors.append({j for _, j in sorted(distances)[:k]})
+    return neighbors
+
+
+@command.command()
+@click.option("--limit", default=200, help="Number of items to sample.")
+@click.option("--decimals", "-d", multiple=True, type=int, default=[3, 4], help="Decimals to benchmark.")
+@click.option("--k", default=10, help="Number of neighbors for recall.")
+def benchmark_embedding(limit: int, decimals: List[int], k: int):
+    """Benchmark compact embedding encodings on payload size, decode time and neighbor recall."""
+    items, cursor, scan_time = [], "", 0.0
+    while len(items) < limit:
+        start = time.perf_counter()
+        page, cursor = gorse_client.get_items(1000, cursor)
+        scan_time += time.perf_counter() - start
+        items.extend(item for item in page if isinstance(item["Labels"], dict) and item["Labels"].get("embedding"))
+        if cursor == "":
+            break
+    items = items[:limit]
+    if len(items) < k + 1:
+        print("Not enough items with embeddings")
+        return
+    print(f"{len(items)} items, get_items scan {scan_time:.2f}s")
+
+    vectors = load_item_embeddings(items)
+    encodings = {"full": lambda vector: vector}
+    for n in decimals:
+        encodings[f"round({n})"] = lambda vector, n=n: compact_embedding(vector, n)
+    encodings["float16"] = lambda vector: unpack_vector(pack_vector(vector, "float16"))
+
+    def int8(vector):
+        scale = max(abs(value) for value in vector) / 127 or 1.0
+        return {"scale": scale, "values": [round(value / scale) for value in vector]}
+
+    encodings["int8"] = int8
+
+    exact = nearest_neighbors(vectors, k)
+    print(f"{'encoding':<12}{'size':>10}{'decode':>12}{'recall@' + str(k):>12}")
+    for name, encode in encodings.items():
+        payloads = [json.dumps(encode(vector)) for vector in vectors]
+        start = time.perf_counter()
+        decoded = [json.loads(payload) for payload in payloads]
+        decode_time = time.perf_counter() - start
+        if name == "int8":
+            decoded = [[value * v["scale"] for value in v["values"]] for v in decoded]
+        approximate = nearest_neighbors(decoded, k)
+        recall = sum(len(a & b) for a, b in zip(exact, approximate)) / (k * len(vectors))
+        size = sum(len(payload) for payload in payloads) / len(payloads)
+        print(
+            f"{name:<12}{size / 1024:>7.1f}KiB{decode_time / len(payloads) * 1e6:>10.1f}us{recall:>12.3f}"
+        )
+
+
 def write_dump(f, data: message.Message):
     bytes_data = data.SerializeToString()
     f.write(len(bytes_data).to_bytes(8, byteorder='little'))